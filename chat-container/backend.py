@@ -1,51 +1,1860 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from llama_cpp import Llama
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import llama_cpp
+import asyncio
+import bisect
+import codecs
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import pickle
+import queue
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+import numpy as np
 import uvicorn
 
-app = FastAPI()
-
 # Path to the GGUF model
 MODEL_PATH = os.path.abspath("models/tinyllama-1.1b-chat-v1.0.Q2_K.gguf")
 
-# Load the model on startup
-llm = Llama(model_path=MODEL_PATH, use_mmap=True, verbose=False)
+# Other GGUF files in the models directory can be picked per request ("model" in the request);
+# they are loaded on first use and the least recently used one is unloaded when loading another
+# would go over this budget. The default model above is always kept loaded.
+MODEL_RAM_BUDGET_MB = int(os.environ.get("MODEL_RAM_BUDGET_MB", "4096"))
+
+# Long-context mode: a bigger default window, a quantized KV cache to keep its memory in check
+# and context shifting, so sessions whose window moves keep their KV cache instead of prefilling
+# the whole history again. Each setting below can also be set on its own.
+LONG_CONTEXT = os.environ.get("LONG_CONTEXT", "0") == "1"
+
+# Context window; llama_cpp defaults to 512 tokens, far too small for chat history. Past the
+# model's trained context, RoPE is scaled linearly to stretch it.
+N_CTX = int(os.environ.get("N_CTX", "8192" if LONG_CONTEXT else "2048"))
+
+# KV cache element type: "f16", "q8_0" (about half of f16) or "q4_0" (about a quarter)
+KV_CACHE_TYPE = os.environ.get("KV_CACHE_TYPE", "q8_0" if LONG_CONTEXT else "f16")
+
+# Shift cached tokens down over the turns the history window dropped instead of re-prefilling
+CONTEXT_SHIFT = os.environ.get("CONTEXT_SHIFT", "1" if LONG_CONTEXT else "0") == "1"
+
+# Room kept free in the context for the answer (capped by max_tokens)
+RESPONSE_TOKEN_RESERVE = int(os.environ.get("RESPONSE_TOKEN_RESERVE", "512"))
+
+# Optional extra cap on history tokens; by default history gets whatever the context has left
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "0")) or None
+
+# Old turns are dropped this many at a time, so the kept window (and its KV cache prefix)
+# stays the same for several requests instead of sliding on every turn
+HISTORY_DROP_STEP = int(os.environ.get("HISTORY_DROP_STEP", "4"))
+
+# Fold dropped turns into a short rolling summary instead of forgetting them (costs one
+# short generation per dropped block, cached afterwards)
+HISTORY_SUMMARY = os.environ.get("HISTORY_SUMMARY", "0") == "1"
+SUMMARY_MAX_TOKENS = 96
+
+# Order in which waiting requests get the model: "fifo", "sjf" (smallest estimated cost first,
+# from prompt length and max_tokens) or "fair" (fair share of tokens between clients, keyed by
+# API key or IP address, so one client's long requests don't hold everyone else up)
+SCHEDULER_POLICY = os.environ.get("SCHEDULER_POLICY", "fifo")
+
+# Requests estimated to cost up to this many tokens count as "short" in the scheduler metrics
+SHORT_JOB_COST = int(os.environ.get("SHORT_JOB_COST", "2256"))
+
+# Largest request body accepted once a gzip-encoded one is inflated (413 above it)
+MAX_INFLATED_BODY_MB = int(os.environ.get("MAX_INFLATED_BODY_MB", "16"))
+
+# How many requests may wait behind the one currently generating before we answer 503
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "4"))
+
+# With 2 or more, /chat and /chat/stream run through a continuous batching engine that decodes
+# up to this many requests together in one llama context (sessions keep the single-thread path)
+BATCH_MAX_SEQUENCES = int(os.environ.get("BATCH_MAX_SEQUENCES", "0"))
+
+# With 1 or more, /chat and /chat/stream are served by this many llama_worker.py processes,
+# each with its own slice of the CPU cores; the GGUF is mmap'd so its weights are shared.
+# Takes precedence over BATCH_MAX_SEQUENCES.
+POOL_WORKERS = int(os.environ.get("POOL_WORKERS", "0"))
+# Seconds the workers get to load and warm up before startup fails
+POOL_READY_TIMEOUT = int(os.environ.get("POOL_READY_TIMEOUT", "600"))
+
+# Optional cache of /chat answers keyed on the prompt and sampling settings: an in-memory LRU
+# in front of a SQLite file, entries expire after RESPONSE_CACHE_TTL seconds. Clients can send
+# "Cache-Control: no-cache" for a fresh sample, or "no-store" to skip the cache entirely.
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_DB = os.path.abspath("response_cache.sqlite3")
+
+# Optional semantic cache: the user message is embedded with the model in embedding mode and
+# an earlier answer is reused when its message is at least this cosine-similar (same model,
+# history and sampling settings only). The index keeps SEMANTIC_CACHE_SIZE entries, LRU.
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", "2048"))
+
+# Idle chat sessions keep their llama state and history in RAM up to this budget, then spill to
+# disk. Sessions unused for SESSION_IDLE_TTL seconds are deleted, and spilled sessions past
+# SESSION_SPILL_MB on disk are deleted oldest first.
+SESSION_CACHE_MB = int(os.environ.get("SESSION_CACHE_MB", "512"))
+SESSION_SPILL_MB = int(os.environ.get("SESSION_SPILL_MB", "4096"))
+SESSION_IDLE_TTL = int(os.environ.get("SESSION_IDLE_TTL", "86400"))
+SESSION_SPILL_DIR = os.path.abspath("sessions")
+
+# Sampling settings shared by the blocking and streaming endpoints
+GENERATION_PARAMS = dict(
+    max_tokens=2000,
+    temperature=0.5,
+    top_p=0.5,
+    top_k=50,
+    repeat_penalty=1.1,
+    stop=["[USER]:", "\n[ASSISTANT]:"]
+)
+
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant. Provide clear and concise responses.\n"
+    "Always give noice reduced answers.\n"
+    "If you don't know the answer, it's okay to say you don't know.\n"
+    "Always you have to give the correct and relevant answer.\n"
+    "If the user asks for a joke, you can provide a joke.\n"
+    "You are not a specialized AI assistant. You are just a generalized AI assistant to chat\n"
+    "with the user and provide relevant answers.\n"
+    "Do not add any irrelevant information in the response.\n"
+)
+
+# Every prompt starts with this text, so its KV cache is computed once and reused
+SYSTEM_PREFIX = f"[SYSTEM]: {SYSTEM_PROMPT}\n"
+
+# Settings from a model's tuning file (written by tinyllama-gguf-cpp/autotune.py) passed to Llama(...)
+TUNING_PARAMS = ("n_threads", "n_threads_batch", "n_batch", "n_ubatch")
+
+def load_tuning(model_path):
+    """Threading and batch sizes saved by autotune.py for a model on this host, or {} for llama.cpp's defaults."""
+    path = model_path + ".tuning.json"
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        tuning = json.load(f)
+    if tuning.get("cpu_count") != os.cpu_count():
+        print(f"Ignoring {path}: tuned on {tuning.get('cpu_count')} CPUs, this host has {os.cpu_count()}")
+        return {}
+    print(f"Using tuned settings from {path}")
+    return {name: tuning[name] for name in TUNING_PARAMS if name in tuning}
+
+# llama.cpp type and bytes per element of each KV cache type (q8_0 / q4_0 blocks hold 32 values)
+KV_CACHE_TYPES = {
+    "f16": (llama_cpp.GGML_TYPE_F16, 2.0),
+    "q8_0": (llama_cpp.GGML_TYPE_Q8_0, 34 / 32),
+    "q4_0": (llama_cpp.GGML_TYPE_Q4_0, 18 / 32),
+}
+
+def context_params(model_path):
+    """Llama(...) settings for the KV cache type and, past the trained context, RoPE scaling."""
+    kv_type = KV_CACHE_TYPES[KV_CACHE_TYPE][0]
+    params = {"type_k": kv_type, "type_v": kv_type}
+    if KV_CACHE_TYPE != "f16":
+        params["flash_attn"] = True  # llama.cpp only supports a quantized V cache with flash attention
+    n_ctx_train = Llama(model_path=model_path, vocab_only=True, verbose=False).n_ctx_train()
+    if N_CTX > n_ctx_train:
+        params["rope_freq_scale"] = n_ctx_train / N_CTX
+    return params
+
+# Loaded on the inference thread during startup, see load_model()
+llm = None
+embedder = None  # the same GGUF in embedding mode, only with SEMANTIC_CACHE
+model_ready = threading.Event()
+model_error = None
+
+# llama.cpp is blocking and the model is not thread-safe, so every generation runs on
+# this single worker thread instead of the event loop.
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llama")
+# Prompts for the batch engine and worker pool are tokenized and windowed here instead, so they
+# don't wait behind a session turn or another model's generation on the llama thread
+prep_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prep")
 
 class ChatRequest(BaseModel):
     history: list[str] = []   # List of conversation history messages (e.g. "[USER]: Hi", "[ASSISTANT]: Hello")
     message: str              # The latest user message
+    model: str = ""           # GGUF file in the models directory, the default model if empty
+    max_tokens: int = 0       # Answer length limit, the server's (which also caps it) if 0
 
-@app.post("/chat")
-async def chat(request: ChatRequest):
-    system_prompt = (
-        "You are a helpful AI assistant. Provide clear and concise responses.\n"
-        "Always give noice reduced answers.\n"
-        "If you don't know the answer, it's okay to say you don't know.\n"
-        "Always you have to give the correct and relevant answer.\n"
-        "If the user asks for a joke, you can provide a joke.\n"
-        "You are not a specialized AI assistant. You are just a generalized AI assistant to chat\n"
-        "with the user and provide relevant answers.\n"
-        "Do not add any irrelevant information in the response.\n"
-    )
+def prefix_state_path():
+    """Snapshot file next to the GGUF, keyed on the prefix text, the model file, the context settings and llama.cpp version."""
+    stat = os.stat(MODEL_PATH)
+    key = f"{SYSTEM_PREFIX}|{stat.st_size}|{stat.st_mtime_ns}|{N_CTX}|{KV_CACHE_TYPE}|{llama_cpp.__version__}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+    return f"{MODEL_PATH}.prefix-{digest}.state"
+
+def load_prefix_state():
+    """Evaluates the system prefix once, or restores it from the on-disk snapshot of a previous run."""
+    tokens = llm.tokenize(SYSTEM_PREFIX.encode("utf-8"))
+    path = prefix_state_path()
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+            llm.load_state(state)
+            if llm.input_ids[:llm.n_tokens].tolist() == tokens:
+                print(f"Loaded system prompt KV snapshot ({len(tokens)} tokens) from {path}")
+                return state, tokens
+        except Exception as e:
+            print(f"Ignoring unusable KV snapshot {path}: {e}")
+    started_at = time.perf_counter()
+    llm.reset()
+    llm.eval(tokens)
+    state = llm.save_state()
+    print(f"Evaluated system prompt ({len(tokens)} tokens) in {time.perf_counter() - started_at:.2f}s")
+    try:
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(state, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Could not save KV snapshot to {path}: {e}")
+    return state, tokens
+
+prefix_state, prefix_tokens = None, None
+
+def restore_prefix():
+    """Puts the system prefix back in the KV cache unless it is still there from the last request."""
+    # llama.cpp reuses the longest token prefix it has already evaluated, so only the
+    # history and the user message get prefilled after this.
+    n = len(prefix_tokens)
+    if llm.n_tokens < n or llm.input_ids[:n].tolist() != prefix_tokens:
+        llm.load_state(prefix_state)
+
+def cached_prefix_length(tokens, cached_tokens=None):
+    """Number of leading tokens that are already evaluated in the KV cache (or in cached_tokens)."""
+    if cached_tokens is None:
+        cached_tokens = llm.input_ids[:llm.n_tokens].tolist()
+    n = 0
+    for cached, token in zip(cached_tokens, tokens):
+        if cached != token:
+            break
+        n += 1
+    return n
+
+def shift_context(tokens):
+    """Reuses the KV cache after the history window dropped turns, instead of prefilling again.
+
+    The cached tokens the new prompt no longer contains (right after the part they share) are
+    removed from the KV cache and the rest is shifted down into their place, so llama.cpp's
+    prefix matching finds it. Returns how many tokens were dropped.
+    """
+    ctx = llm._ctx.ctx
+    if hasattr(llama_cpp, "llama_kv_cache_can_shift") and not llama_cpp.llama_kv_cache_can_shift(ctx):
+        return 0
+    cached = llm.input_ids[:llm.n_tokens].tolist()
+    n_keep = cached_prefix_length(tokens, cached)
+    if n_keep == 0 or n_keep == len(cached):
+        return 0
+    # Where the rest of the new prompt continues in the cache (matching up to 16 tokens, at least 4)
+    for start in range(n_keep + 1, len(cached)):
+        n = min(16, len(cached) - start, len(tokens) - n_keep)
+        if n >= 4 and cached[start:start + n] == tokens[n_keep:n_keep + n]:
+            break
+    else:
+        return 0
+    n_discard = start - n_keep
+    llama_cpp.llama_kv_cache_seq_rm(ctx, 0, n_keep, start)
+    llama_cpp.llama_kv_cache_seq_add(ctx, 0, start, -1, -n_discard)
+    remaining = cached[start:]
+    llm.input_ids[n_keep:n_keep + len(remaining)] = remaining
+    llm.n_tokens = n_keep + len(remaining)
+    return n_discard
+
+def kv_cache_bytes(model, n_ctx=None, kv_type=KV_CACHE_TYPE):
+    """Size of a model's KV cache (at its own n_ctx by default), from the GGUF metadata."""
+    arch = model.metadata.get("general.architecture", "llama")
+    n_layer = int(model.metadata[f"{arch}.block_count"])
+    n_embd = int(model.metadata[f"{arch}.embedding_length"])
+    n_head = int(model.metadata[f"{arch}.attention.head_count"])
+    n_head_kv = int(model.metadata.get(f"{arch}.attention.head_count_kv", n_head))
+    # Keys and values for every layer and position
+    return int(2 * n_layer * (n_ctx or model.n_ctx()) * (n_embd * n_head_kv // n_head) * KV_CACHE_TYPES[kv_type][1])
+
+class ModelRegistry:
+    """GGUF models found in a directory, loaded on first use and unloaded least recently used first.
+
+    A model's resident size is its file size (the mmap'd weights) plus its KV cache. Loads and
+    unloads only happen on the llama thread; the lock keeps /models and /metrics consistent.
+    """
+    def __init__(self, models_dir, budget_bytes, default_name):
+        self.models_dir = models_dir
+        self.budget_bytes = budget_bytes
+        self.default_name = default_name
+        self.loaded = OrderedDict()  # name -> {"llm", "resident_bytes", "pinned", "loaded_at", "last_used"}
+        self.events = deque(maxlen=100)
+        self.stats = {"loads": 0, "evictions": 0}
+        self.lock = threading.Lock()
+
+    def available(self):
+        """Every GGUF file in the models directory, by file name."""
+        if not os.path.isdir(self.models_dir):
+            return {}
+        return {
+            name: os.path.join(self.models_dir, name)
+            for name in sorted(os.listdir(self.models_dir)) if name.endswith(".gguf")
+        }
+
+    def resolve(self, name):
+        """Canonical file name for a requested model, raising KeyError for unknown ones."""
+        if not name:
+            return self.default_name
+        if not name.endswith(".gguf"):
+            name += ".gguf"
+        if name not in self.loaded and name not in self.available():
+            raise KeyError(name)
+        return name
+
+    def add(self, name, model, pinned):
+        with self.lock:
+            self.loaded[name] = {
+                "llm": model,
+                "resident_bytes": os.path.getsize(model.model_path) + kv_cache_bytes(model),
+                "pinned": pinned,
+                "loaded_at": time.time(),
+                "last_used": time.time(),
+            }
+
+    def resident_bytes(self):
+        return sum(entry["resident_bytes"] for entry in self.loaded.values())
+
+    def get(self, name):
+        """Returns the loaded Llama for a model, loading it (and unloading others) if needed."""
+        name = self.resolve(name)
+        with self.lock:
+            entry = self.loaded.get(name)
+            if entry is not None:
+                self.loaded.move_to_end(name)
+                entry["last_used"] = time.time()
+                return entry["llm"]
+        path = self.available()[name]
+        if not self.evict_for(os.path.getsize(path)):
+            raise RuntimeError(f"{name} does not fit in MODEL_RAM_BUDGET_MB ({self.budget_bytes // 2**20} MB)")
+        started_at = time.perf_counter()
+        model = Llama(
+            model_path=path, n_ctx=N_CTX, use_mmap=True, verbose=False, **context_params(path), **load_tuning(path)
+        )
+        self.add(name, model, pinned=False)
+        with self.lock:
+            self.log_event("load", name, self.loaded[name], seconds=round(time.perf_counter() - started_at, 2))
+        # The file size was only an estimate; make room for the KV cache too
+        if not self.evict_for(0, keep=name):
+            print(f"Warning: loaded models exceed MODEL_RAM_BUDGET_MB ({self.budget_bytes // 2**20} MB)")
+        return model
+
+    def evict_for(self, extra_bytes, keep=None):
+        """Unloads unpinned models, least recently used first, until extra_bytes more fit the budget.
+
+        Returns False if they still don't fit once nothing is left to unload.
+        """
+        with self.lock:
+            while self.resident_bytes() + extra_bytes > self.budget_bytes:
+                candidates = [name for name, entry in self.loaded.items() if not entry["pinned"] and name != keep]
+                if not candidates:
+                    return False
+                entry = self.loaded.pop(candidates[0])
+                entry["llm"].close()
+                self.log_event("evict", candidates[0], entry)
+        return True
+
+    def log_event(self, event, name, entry, **details):
+        """Prints a load or eviction and keeps it for /models (caller holds the lock)."""
+        self.events.append({"event": event, "model": name, "resident_bytes": entry["resident_bytes"], "at": time.time(), **details})
+        self.stats["loads" if event == "load" else "evictions"] += 1
+        print(f"Model {event}: {name} ({entry['resident_bytes'] / 2**20:.0f} MB resident)")
+
+    def snapshot(self):
+        """Available and loaded models with their resident sizes, plus the recent events."""
+        with self.lock:
+            loaded = {
+                name: {key: value for key, value in entry.items() if key != "llm"}
+                for name, entry in self.loaded.items()
+            }
+            events = list(self.events)
+            stats = dict(self.stats)
+        return {
+            "default": self.default_name,
+            "budget_bytes": self.budget_bytes,
+            "resident_bytes": sum(entry["resident_bytes"] for entry in loaded.values()),
+            "models": [
+                {"name": name, "file_bytes": os.path.getsize(path), "loaded": name in loaded, **loaded.get(name, {})}
+                for name, path in self.available().items()
+            ],
+            "events": events,
+            **stats,
+        }
+
+registry = ModelRegistry(os.path.dirname(MODEL_PATH), MODEL_RAM_BUDGET_MB * 1024 * 1024, os.path.basename(MODEL_PATH))
+
+class SessionStore:
+    """LRU of per-session histories and llama states, bounded by a memory budget.
+
+    Sessions evicted from memory are pickled to spill_dir and loaded back on the next turn.
+    Sessions idle for longer than ttl_seconds are deleted, and so are the oldest spilled
+    files once they take more than spill_budget_bytes.
+    """
+    def __init__(self, budget_bytes, spill_dir, spill_budget_bytes, ttl_seconds):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir
+        self.spill_budget_bytes = spill_budget_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sessions = OrderedDict()  # session_id -> (history, LlamaState or None)
+        self.sizes = {}  # session_id -> bytes its history and state take in memory
+        self.last_used = {}  # session_id -> time.time() of its last turn
+        self.resident_bytes = 0
+        self.swept_at = 0.0
+        self.lock = threading.Lock()
+        os.makedirs(spill_dir, exist_ok=True)
+        self.sweep()  # sessions spilled by an earlier run
+
+    def spill_path(self, session_id):
+        return os.path.join(self.spill_dir, f"{session_id}.session")
+
+    def create(self, history):
+        session_id = uuid.uuid4().hex
+        self.put(session_id, history, None)
+        return session_id
+
+    def get(self, session_id):
+        """Returns (history, state) for a session, reloading it from disk if it was spilled."""
+        if not session_id.isalnum():
+            return None
+        with self.lock:
+            if session_id in self.sessions:
+                self.sessions.move_to_end(session_id)
+                self.last_used[session_id] = time.time()
+                return self.sessions[session_id]
+        path = self.spill_path(session_id)
+        try:
+            with open(path, "rb") as f:
+                history, state = pickle.load(f)
+            os.remove(path)
+        except FileNotFoundError:  # never existed, or expired or deleted meanwhile
+            return None
+        self.put(session_id, history, state)
+        return history, state
+
+    def put(self, session_id, history, state):
+        with self.lock:
+            self.discard(session_id)
+            self.sessions[session_id] = (history, state)
+            self.sizes[session_id] = sum(len(item) for item in history)
+            self.sizes[session_id] += state.llama_state_size if state is not None else 0
+            self.last_used[session_id] = time.time()
+            self.resident_bytes += self.sizes[session_id]
+            # Spill least recently used sessions until we are back under budget
+            while self.resident_bytes > self.budget_bytes and len(self.sessions) > 1:
+                evicted_id = next(iter(self.sessions))
+                last_used = self.last_used[evicted_id]
+                evicted = self.discard(evicted_id)
+                path = self.spill_path(evicted_id)
+                with open(path, "wb") as f:
+                    pickle.dump(evicted, f)
+                # The file's mtime is when the session was last used, for the TTL and the disk cap
+                os.utime(path, (last_used, last_used))
+        if time.time() - self.swept_at > 60:
+            self.sweep()
+
+    def discard(self, session_id):
+        """Drops a session from memory (caller holds the lock) and returns it."""
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.resident_bytes -= self.sizes.pop(session_id)
+            del self.last_used[session_id]
+        return session
+
+    def delete(self, session_id):
+        if not session_id.isalnum():
+            return False
+        with self.lock:
+            found = self.discard(session_id) is not None
+        try:
+            os.remove(self.spill_path(session_id))
+            found = True
+        except FileNotFoundError:
+            pass
+        return found
+
+    def sweep(self):
+        """Deletes expired sessions, then the oldest spilled files past the disk budget."""
+        self.swept_at = time.time()
+        expires_before = self.swept_at - self.ttl_seconds
+        with self.lock:
+            while self.sessions and self.last_used[next(iter(self.sessions))] < expires_before:
+                self.discard(next(iter(self.sessions)))
+        spilled = []
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            spilled.append((stat.st_mtime, stat.st_size, path))
+        kept_bytes = 0
+        for mtime, size, path in sorted(spilled, reverse=True):  # most recently used first
+            if mtime >= expires_before and kept_bytes + size <= self.spill_budget_bytes:
+                kept_bytes += size
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+sessions = SessionStore(
+    SESSION_CACHE_MB * 1024 * 1024, SESSION_SPILL_DIR, SESSION_SPILL_MB * 1024 * 1024, SESSION_IDLE_TTL
+)
+
+class SessionCreateRequest(BaseModel):
+    history: list[str] = []   # Optional earlier turns to seed the session with
+
+class SessionMessageRequest(BaseModel):
+    message: str
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Token count of a piece of prompt text according to the model's own tokenizer."""
+    return len(llm.tokenize(text.encode("utf-8"), add_bos=False))
+
+summary_cache = OrderedDict()  # hash of all dropped turns -> rolling summary of them
+summary_lock = threading.Lock()
+
+def call_on_llama_thread(fn, *args, **kwargs):
+    """Calls fn on the inference thread, waiting for it when called from another thread."""
+    if threading.current_thread().name.startswith("llama_"):
+        return fn(*args, **kwargs)
+    return inference_executor.submit(fn, *args, **kwargs).result()
+
+def summarize_dropped(dropped):
+    """Folds dropped turns into a rolling summary, one HISTORY_DROP_STEP block at a time."""
+    summary = ""
+    for end in range(HISTORY_DROP_STEP, len(dropped) + HISTORY_DROP_STEP, HISTORY_DROP_STEP):
+        block = dropped[end - HISTORY_DROP_STEP:end]
+        key = hashlib.sha1("\n".join(dropped[:end]).encode("utf-8")).hexdigest()
+        with summary_lock:
+            cached = summary_cache.get(key)
+            if cached is not None:
+                summary_cache.move_to_end(key)
+        if cached is not None:
+            summary = cached
+            continue
+        previous = f"Earlier summary: {summary}\n" if summary else ""
+        transcript = "".join(item + "\n" for item in block)
+        response = call_on_llama_thread(
+            llm,
+            f"[SYSTEM]: Summarize the conversation below in at most two short sentences.\n"
+            f"{previous}{transcript}[SUMMARY]:",
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0.2,
+            stop=["\n[", "[USER]:"],
+        )
+        summary = response["choices"][0]["text"].strip()
+        with summary_lock:
+            summary_cache[key] = summary
+            if len(summary_cache) > 256:
+                summary_cache.popitem(last=False)
+    return summary
+
+def window_history(history, message):
+    """Keeps the newest history turns that fit the token budget.
+
+    Returns the kept turns, a summary of the dropped ones (empty unless HISTORY_SUMMARY
+    is on) and a report of the decision for the response.
+    """
+    reserve = min(GENERATION_PARAMS["max_tokens"], RESPONSE_TOKEN_RESERVE)
+    fixed = count_tokens(SYSTEM_PREFIX) + count_tokens(f"[USER]: {message}\n[ASSISTANT]:") + 1  # +1 for BOS
+    if HISTORY_SUMMARY:
+        fixed += SUMMARY_MAX_TOKENS + count_tokens("[SYSTEM]: Summary of the earlier conversation: \n")
+    budget = llm.n_ctx() - reserve - fixed
+    if HISTORY_TOKEN_BUDGET is not None:
+        budget = min(budget, HISTORY_TOKEN_BUDGET)
+    budget = max(budget, 0)
+
+    turn_tokens = [count_tokens(item + "\n") for item in history]
+    history_tokens = sum(turn_tokens)
+    dropped = 0
+    kept_tokens = history_tokens
+    while kept_tokens > budget:
+        kept_tokens -= turn_tokens[dropped]
+        dropped += 1
+    if dropped:
+        # Round up to a whole step so the window does not move again until the next step fills
+        dropped = min(-(-dropped // HISTORY_DROP_STEP) * HISTORY_DROP_STEP, len(history))
+        kept_tokens = sum(turn_tokens[dropped:])
+
+    summary = summarize_dropped(history[:dropped]) if HISTORY_SUMMARY and dropped else ""
+    summary_tokens = count_tokens(summary) if summary else 0
+    report = {
+        "budget_tokens": budget,
+        "history_turns": len(history),
+        "kept_turns": len(history) - dropped,
+        "dropped_turns": dropped,
+        "history_tokens": history_tokens,
+        "kept_history_tokens": kept_tokens,
+        "summary_tokens": summary_tokens,
+        "tokens_saved": history_tokens - kept_tokens - summary_tokens,
+    }
+    return history[dropped:], summary, report
+
+def build_prompt(request):
+    """Builds the full prompt from the system prompt, the windowed history and the latest message."""
+    history, summary, context = window_history(request.history, request.message)
     # Build the full prompt with context:
-    prompt = f"[SYSTEM]: {system_prompt}\n"
-    for item in request.history:
+    prompt = SYSTEM_PREFIX
+    if summary:
+        prompt += f"[SYSTEM]: Summary of the earlier conversation: {summary}\n"
+    for item in history:
         prompt += item + "\n"
     prompt += f"[USER]: {request.message}\n[ASSISTANT]:"
+    return prompt, context
+
+cancel_stats = {"cancelled_requests": 0, "tokens_saved": 0}
+cancel_stats_lock = threading.Lock()
+
+def record_cancellation(prompt_tokens, completion_tokens):
+    """Counts a generation stopped because its client went away."""
+    # tokens_saved is the part of the max_tokens budget that was never generated (an upper bound)
+    budget = min(GENERATION_PARAMS["max_tokens"], N_CTX - prompt_tokens)
+    with cancel_stats_lock:
+        cancel_stats["cancelled_requests"] += 1
+        cancel_stats["tokens_saved"] += max(budget - completion_tokens, 0)
+
+class Histogram:
+    """Prometheus histogram: cumulative bucket counts, sum and count, rendered in the text format."""
+    def __init__(self, name, help_text, buckets, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labels = "".join(f'{key}="{value}",' for key, value in (labels or {}).items())
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, header=True):
+        """Text format lines; header=False for further label sets of an already rendered metric."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"] if header else []
+        cumulative = 0
+        for bound, count in zip([*self.buckets, "+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{self.labels}le="{bound}"}} {cumulative}')
+        labels = f"{{{self.labels.rstrip(',')}}}" if self.labels else ""
+        lines.append(f"{self.name}_sum{labels} {self.sum}")
+        lines.append(f"{self.name}_count{labels} {self.count}")
+        return "\n".join(lines)
+
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+TOKEN_BUCKETS = [16, 32, 64, 128, 256, 512, 1024, 2048, 4096]
+
+histograms = {
+    "queue_wait_ms": Histogram("llm_queue_wait_seconds", "Time a request waited before generation started.", SECONDS_BUCKETS),
+    "prompt_eval_ms": Histogram("llm_prompt_eval_seconds", "Time from generation start to the first sampled token.", SECONDS_BUCKETS),
+    "time_to_first_token_ms": Histogram("llm_time_to_first_token_seconds", "Time from submission to the first token.", SECONDS_BUCKETS),
+    "tokens_per_second": Histogram("llm_decode_tokens_per_second", "Decode speed after the first token.", [1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200]),
+    "prompt_tokens": Histogram("llm_prompt_tokens", "Prompt length in tokens.", TOKEN_BUCKETS),
+    "completion_tokens": Histogram("llm_completion_tokens", "Generated tokens per request.", TOKEN_BUCKETS),
+}
+finished_requests = {}  # finish_reason -> count
+metrics_lock = threading.Lock()
+
+def request_timings(submitted_at, started_at, first_token_at, finished_at, completion_tokens):
+    """Timing breakdown of one generation, in milliseconds, from perf_counter() readings."""
+    decode_seconds = finished_at - first_token_at
+    return {
+        "queue_wait_ms": round((started_at - submitted_at) * 1000, 1),
+        "prompt_eval_ms": round((first_token_at - started_at) * 1000, 1),
+        "time_to_first_token_ms": round((first_token_at - submitted_at) * 1000, 1),
+        "inference_ms": round((finished_at - started_at) * 1000, 1),
+        "tokens_per_second": round(completion_tokens / decode_seconds, 2) if decode_seconds > 0 else None,
+    }
+
+def observe_request(finish_reason, usage, timings):
+    """Adds one finished generation to the /metrics histograms."""
+    with metrics_lock:
+        finished_requests[finish_reason] = finished_requests.get(finish_reason, 0) + 1
+        for name, histogram in histograms.items():
+            value = usage.get(name, timings.get(name))
+            if value is None:
+                continue
+            histogram.observe(value / 1000 if name.endswith("_ms") else value)
+
+def server_timing(timings):
+    """Server-Timing header value with the same breakdown as the timings in the response body."""
+    decode_ms = timings["inference_ms"] - timings["prompt_eval_ms"]
+    return ", ".join([
+        f"queue;dur={timings['queue_wait_ms']}",
+        f"prompt_eval;dur={timings['prompt_eval_ms']}",
+        f"ttft;dur={timings['time_to_first_token_ms']}",
+        f"decode;dur={round(decode_ms, 1)}",
+        f"total;dur={round(timings['queue_wait_ms'] + timings['inference_ms'], 1)}",
+    ])
+
+def generation_params(request):
+    """GENERATION_PARAMS with the request's own max_tokens, if it asked for a shorter answer."""
+    if 0 < request.max_tokens < GENERATION_PARAMS["max_tokens"]:
+        return dict(GENERATION_PARAMS, max_tokens=request.max_tokens)
+    return GENERATION_PARAMS
+
+def run_stream(request, submitted_at, emit, cancel):
+    """Streams tokens from llama.cpp to emit() as they are sampled, then a final usage event.
+
+    Generation stops at the next token boundary once cancel is set. Requests for another
+    model than the default one load it through the registry first.
+    """
+    started_at = time.perf_counter()
+    first_token_at = None
+    completion_tokens = 0
+    finish_reason = None
+    try:
+        if cancel.is_set():
+            record_cancellation(0, 0)
+            return
+        prompt, context = build_prompt(request)
+        model = registry.get(request.model)
+        if model is llm:
+            restore_prefix()
+            if CONTEXT_SHIFT:
+                # Helps when this request continues the conversation the cache already holds
+                shift_context(llm.tokenize(prompt.encode("utf-8")))
+        for chunk in model(prompt, stream=True, **generation_params(request)):
+            if cancel.is_set():
+                finish_reason = "cancelled"
+                break
+            choice = chunk["choices"][0]
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            completion_tokens += 1
+            finish_reason = choice.get("finish_reason") or finish_reason
+            if choice["text"]:
+                emit("token", {"token": choice["text"]})
+        finished_at = time.perf_counter()
+        first_token_at = first_token_at or finished_at
+        prompt_tokens = len(model.tokenize(prompt.encode("utf-8")))
+        if finish_reason == "cancelled":
+            record_cancellation(prompt_tokens, completion_tokens)
+        emit("done", {
+            "finish_reason": finish_reason,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "timings": request_timings(submitted_at, started_at, first_token_at, finished_at, completion_tokens),
+            "context": context,
+        })
+    except Exception as e:
+        emit("error", {"detail": str(e)})
+    finally:
+        emit(None, None)
+
+class BatchEngine:
+    """Continuous batching: several chat sequences share one llama context and every decode step.
+
+    New requests are admitted into the running batch as soon as a sequence slot is free;
+    their prompts are prefilled in chunks alongside the decode tokens of the others, and
+    each sequence is retired as soon as it hits a stop string, EOS or max_tokens.
+    """
+    def __init__(self, max_sequences):
+        params = llama_cpp.llama_context_params.from_buffer_copy(llm.context_params)
+        params.n_ctx = N_CTX * max_sequences
+        params.n_seq_max = max_sequences + 1  # sequence 0 holds the shared system prefix
+        self.ctx = llama_cpp.llama_new_context_with_model(llm.model, params)
+        self.n_batch = params.n_batch
+        self.batch = llama_cpp.llama_batch_init(self.n_batch, 0, 1)
+        self.n_vocab = llm.n_vocab()
+        self.eos = llm.token_eos()
+        self.rng = np.random.default_rng()
+        self.free_seq_ids = list(range(1, max_sequences + 1))
+        self.waiting = queue.Queue()
+        self.active = []
+        # Evaluate the system prefix once; new sequences copy its KV cells instead of prefilling it
+        for start in range(0, len(prefix_tokens), self.n_batch):
+            self.batch.n_tokens = 0
+            for pos in range(start, min(start + self.n_batch, len(prefix_tokens))):
+                self.add(prefix_tokens[pos], pos, 0, False)
+            llama_cpp.llama_decode(self.ctx, self.batch)
+        threading.Thread(target=self.run, daemon=True, name="llama-batch").start()
+
+    def submit(self, prompt, params, submitted_at, emit, cancel, context):
+        """Queues a prompt; emit(event, data) receives token/done/error events and a final None."""
+        tokens = llm.tokenize(prompt.encode("utf-8"))
+        self.waiting.put({
+            "tokens": list(tokens), "n_prompt": len(tokens), "n_past": 0,
+            "max_tokens": min(params["max_tokens"], N_CTX - len(tokens)),
+            "text": "", "emitted": 0, "decoder": codecs.getincrementaldecoder("utf-8")("ignore"),
+            "submitted_at": submitted_at, "emit": emit, "cancel": cancel, "context": context,
+        })
+
+    def add(self, token, pos, seq_id, logits):
+        i = self.batch.n_tokens
+        self.batch.token[i] = token
+        self.batch.pos[i] = pos
+        self.batch.n_seq_id[i] = 1
+        self.batch.seq_id[i][0] = seq_id
+        self.batch.logits[i] = logits
+        self.batch.n_tokens = i + 1
+
+    def admit(self, seq):
+        if seq["cancel"].is_set():
+            record_cancellation(seq["n_prompt"], 0)
+            seq["emit"](None, None)
+            return
+        if seq["n_prompt"] >= N_CTX:
+            seq["emit"]("error", {"detail": f"Prompt ({seq['n_prompt']} tokens) exceeds the context window ({N_CTX})"})
+            seq["emit"](None, None)
+            return
+        seq["seq_id"] = self.free_seq_ids.pop()
+        seq["admitted_at"] = time.perf_counter()
+        seq["first_token_at"] = None
+        # Share the system prefix cells; keep at least one prompt token to evaluate for logits
+        reused = min(cached_prefix_length(seq["tokens"], prefix_tokens), seq["n_prompt"] - 1)
+        if reused > 0:
+            llama_cpp.llama_kv_cache_seq_cp(self.ctx, 0, seq["seq_id"], 0, reused)
+        seq["n_past"] = reused
+        self.active.append(seq)
+
+    def retire(self, seq, finish_reason):
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq["seq_id"], -1, -1)
+        self.free_seq_ids.append(seq["seq_id"])
+        self.active.remove(seq)
+        if seq["emitted"] < len(seq["text"]):
+            seq["emit"]("token", {"token": seq["text"][seq["emitted"]:]})
+        finished_at = time.perf_counter()
+        first_token_at = seq["first_token_at"] or finished_at
+        completion_tokens = len(seq["tokens"]) - seq["n_prompt"]
+        if finish_reason == "cancelled":
+            record_cancellation(seq["n_prompt"], completion_tokens)
+        seq["emit"]("done", {
+            "finish_reason": finish_reason,
+            "usage": {
+                "prompt_tokens": seq["n_prompt"],
+                "completion_tokens": completion_tokens,
+                "total_tokens": len(seq["tokens"]),
+            },
+            "timings": request_timings(
+                seq["submitted_at"], seq["admitted_at"], first_token_at, finished_at, completion_tokens
+            ),
+            "context": seq["context"],
+        })
+        seq["emit"](None, None)
+
+    def sample(self, seq, logits):
+        """Repeat penalty, top-k, top-p and temperature sampling, in llama.cpp's order."""
+        logits = logits.copy()
+        recent = np.unique(seq["tokens"][-64:])
+        penalty = GENERATION_PARAMS["repeat_penalty"]
+        logits[recent] = np.where(logits[recent] > 0, logits[recent] / penalty, logits[recent] * penalty)
+        candidates = np.argpartition(logits, -GENERATION_PARAMS["top_k"])[-GENERATION_PARAMS["top_k"]:]
+        candidates = candidates[np.argsort(-logits[candidates])]
+        probs = np.exp(logits[candidates] - logits[candidates[0]])
+        probs /= probs.sum()
+        keep = int(np.searchsorted(np.cumsum(probs), GENERATION_PARAMS["top_p"])) + 1
+        candidates = candidates[:keep]
+        scaled = logits[candidates] / GENERATION_PARAMS["temperature"]
+        probs = np.exp(scaled - scaled.max())
+        return int(self.rng.choice(candidates, p=probs / probs.sum()))
+
+    def accept(self, seq, token):
+        """Appends a sampled token, streams the text that can no longer be part of a stop string."""
+        if seq["first_token_at"] is None:
+            seq["first_token_at"] = time.perf_counter()
+        if token == self.eos:
+            return "stop"
+        seq["tokens"].append(token)
+        seq["text"] += seq["decoder"].decode(llm.detokenize([token]))
+        for stop in GENERATION_PARAMS["stop"]:
+            index = seq["text"].find(stop)
+            if index != -1:
+                seq["text"] = seq["text"][:index]
+                return "stop"
+        if len(seq["tokens"]) - seq["n_prompt"] >= seq["max_tokens"]:
+            return "length"
+        hold = max(
+            (k for stop in GENERATION_PARAMS["stop"] for k in range(1, len(stop)) if seq["text"].endswith(stop[:k])),
+            default=0,
+        )
+        if len(seq["text"]) - hold > seq["emitted"]:
+            seq["emit"]("token", {"token": seq["text"][seq["emitted"]:len(seq["text"]) - hold]})
+            seq["emitted"] = len(seq["text"]) - hold
+        return None
 
-    response = llm(
-        prompt,
-        max_tokens=2000,
-        temperature=0.5,
-        top_p=0.5,
-        top_k=50,
-        repeat_penalty=1.1,
-        stop=["[USER]:", "\n[ASSISTANT]:"]
+    def step(self):
+        """Builds one batch (decode tokens first, then prefill chunks), decodes it and samples."""
+        self.batch.n_tokens = 0
+        rows = []  # (batch index, sequence) whose logits we sample from
+        for seq in sorted(self.active, key=lambda s: len(s["tokens"]) - s["n_past"]):
+            pending = len(seq["tokens"]) - seq["n_past"]
+            take = min(pending, self.n_batch - self.batch.n_tokens)
+            if take <= 0:
+                break
+            for i in range(take):
+                pos = seq["n_past"] + i
+                last = pos == len(seq["tokens"]) - 1
+                self.add(seq["tokens"][pos], pos, seq["seq_id"], last)
+                if last:
+                    rows.append((self.batch.n_tokens - 1, seq))
+            seq["n_past"] += take
+        if llama_cpp.llama_decode(self.ctx, self.batch) != 0:
+            raise RuntimeError("llama_decode failed (KV cache full?)")
+        for index, seq in rows:
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.ctx, index), shape=(self.n_vocab,))
+            finish_reason = self.accept(seq, self.sample(seq, logits))
+            if finish_reason is not None:
+                self.retire(seq, finish_reason)
+
+    def run(self):
+        while True:
+            if not self.active:
+                self.admit(self.waiting.get())
+            while self.free_seq_ids and not self.waiting.empty():
+                self.admit(self.waiting.get_nowait())
+            # Free the slots of requests whose clients went away
+            for seq in [seq for seq in self.active if seq["cancel"].is_set()]:
+                self.retire(seq, "cancelled")
+            if not self.active:
+                continue
+            try:
+                self.step()
+            except Exception as e:
+                # Fail the whole batch rather than lose the engine thread
+                for seq in self.active:
+                    seq["emit"]("error", {"detail": str(e)})
+                    seq["emit"](None, None)
+                    llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq["seq_id"], -1, -1)
+                    self.free_seq_ids.append(seq["seq_id"])
+                self.active.clear()
+
+class WorkerPool:
+    """Dispatches prompts to llama_worker.py processes, each job to the next free worker.
+
+    Workers load the same GGUF with mmap, so the weights sit in the page cache once and
+    each extra worker only costs its own context and KV cache. A worker that exits after
+    startup is started again on the same cores.
+    """
+    def __init__(self, size, llama_params):
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count() or 1))
+        per_worker = max(1, len(cpus) // size)
+        self.script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llama_worker.py")
+        self.llama_params = llama_params
+        self.size = size
+        self.live = 0  # workers that are ready and have not exited
+        self.workers = []
+        self.jobs = queue.Queue()
+        self.idle = queue.Queue()
+        self.job_ids = iter(range(1, sys.maxsize))
+        self.ready = threading.Semaphore(0)
+        self.started = False
+        self.startup_error = None
+        self.closed = False
+        self.lock = threading.Lock()
+        for i in range(size):
+            self.spawn(cpus[i * per_worker:(i + 1) * per_worker] or cpus[-per_worker:])
+        threading.Thread(target=self.dispatch, daemon=True, name="llama-pool").start()
+
+    def spawn(self, cpu_slice, failures=0):
+        """Starts a worker process on cpu_slice; failures counts its predecessors that died before ready."""
+        process = subprocess.Popen(
+            [sys.executable, self.script, MODEL_PATH, str(N_CTX), ",".join(map(str, cpu_slice)), json.dumps(self.llama_params)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1,
+        )
+        worker = {"process": process, "cpus": cpu_slice, "job": None, "ready": False, "alive": True, "failures": failures}
+        with self.lock:
+            self.workers.append(worker)
+        threading.Thread(target=self.read_events, args=(worker,), daemon=True).start()
+
+    def wait_ready(self, timeout):
+        """Blocks until every worker has loaded and warmed up its model; raises if one exits first or time runs out."""
+        deadline = time.monotonic() + timeout
+        for _ in range(self.size):
+            if not self.ready.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                self.startup_error = f"Llama workers were not ready after {timeout}s"
+            if self.startup_error is not None:
+                self.close()
+                raise RuntimeError(self.startup_error)
+        self.started = True
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            for worker in self.workers:
+                worker["process"].kill()
+
+    def submit(self, prompt, params, submitted_at, emit, cancel, context):
+        """Queues a prompt; emit(event, data) receives token/done/error events and a final None."""
+        self.jobs.put({
+            "id": next(self.job_ids), "prompt": prompt, "params": params, "submitted_at": submitted_at,
+            "emit": emit, "cancel": cancel, "cancel_sent": False, "context": context,
+        })
+
+    def send(self, worker, message):
+        worker["process"].stdin.write(json.dumps(message) + "\n")
+        worker["process"].stdin.flush()
+
+    def dispatch(self):
+        while True:
+            job = self.jobs.get()
+            worker = self.idle.get()
+            while not worker["alive"]:  # exited while idle, read_events() starts a new one
+                worker = self.idle.get()
+            if job["cancel"].is_set():
+                record_cancellation(0, 0)
+                job["emit"](None, None)
+                self.idle.put(worker)
+                continue
+            job["dispatched_at"] = time.perf_counter()
+            with self.lock:
+                alive = worker["alive"]
+                if alive:
+                    worker["job"] = job
+            if not alive:
+                self.jobs.put(job)  # it exited just now; try the next free worker
+                continue
+            try:
+                self.send(worker, {"id": job["id"], "prompt": job["prompt"], "params": job["params"]})
+            except OSError:
+                pass  # it exited just now; read_events() fails the job
+
+    def read_events(self, worker):
+        for line in worker["process"].stdout:
+            message = json.loads(line)
+            event, data, job = message["event"], message["data"], worker["job"]
+            if event == "ready":
+                print(f"Llama worker {data['pid']} ready on cpus {data['cpus']}")
+                worker["ready"] = True
+                with self.lock:
+                    self.live += 1
+                self.idle.put(worker)
+                if self.started:
+                    scheduler.wake()  # capacity() grew back
+                else:
+                    self.ready.release()
+                continue
+            if job["cancel"].is_set() and not job["cancel_sent"]:
+                # Tell the worker to stop at its next token; it answers with a "cancelled" done event
+                self.send(worker, {"cancel": job["id"]})
+                job["cancel_sent"] = True
+            if event == "done":
+                if data["finish_reason"] == "cancelled":
+                    record_cancellation(data["usage"]["prompt_tokens"], data["usage"]["completion_tokens"])
+                queue_wait_ms = round((job["dispatched_at"] - job["submitted_at"]) * 1000, 1)
+                data["timings"] = {
+                    "queue_wait_ms": queue_wait_ms,
+                    **data["timings"],
+                    "time_to_first_token_ms": round(queue_wait_ms + data["timings"]["prompt_eval_ms"], 1),
+                }
+                data["context"] = job["context"]
+            job["emit"](event, data)
+            if event in ("done", "error"):
+                job["emit"](None, None)
+                worker["job"] = None
+                self.idle.put(worker)
+        # The worker died: fail whatever it was running, then start a replacement
+        code = worker["process"].wait()
+        print(f"Llama worker exited with code {code}")
+        with self.lock:
+            worker["alive"] = False
+            job = worker["job"]
+            self.workers.remove(worker)
+            self.live -= worker["ready"]
+        if job is not None:
+            job["emit"]("error", {"detail": "Llama worker process exited"})
+            job["emit"](None, None)
+        if self.closed:
+            return
+        if not self.started:
+            self.startup_error = f"Llama worker exited with code {code} before it was ready"
+            self.ready.release()
+            return
+        # Back off while replacements keep dying before they are ready
+        failures = 0 if worker["ready"] else worker["failures"] + 1
+        time.sleep(min(2 ** failures, 60))
+        if not self.closed:
+            self.spawn(worker["cpus"], failures)
+
+engine = None
+pool = None
+
+# Where /chat and /chat/stream go instead of the single llama thread, if anywhere
+offload = None
+
+def log_memory_cost(params):
+    """Prints what the context settings cost in memory with the loaded model."""
+    mb = lambda n: f"{n / 2**20:.0f} MB"
+    kv = kv_cache_bytes(llm)
+    print(f"Memory: weights {mb(os.path.getsize(MODEL_PATH))} (mmap'd, shared by every context and worker)")
+    print(f"Memory: KV cache n_ctx={N_CTX} {KV_CACHE_TYPE} {mb(kv)} (f16 would be {mb(kv_cache_bytes(llm, kv_type='f16'))})")
+    if "rope_freq_scale" in params:
+        print(f"Context: N_CTX is past the trained {llm.n_ctx_train()} tokens, RoPE scaled by {params['rope_freq_scale']:.3f}")
+    if POOL_WORKERS >= 1:
+        print(f"Memory: {POOL_WORKERS} pool workers add {mb(kv * POOL_WORKERS)} of KV cache")
+    elif BATCH_MAX_SEQUENCES > 1:
+        print(f"Memory: batch engine adds {mb(kv * BATCH_MAX_SEQUENCES)} of KV cache ({BATCH_MAX_SEQUENCES} x n_ctx)")
+    if SEMANTIC_CACHE:
+        print(f"Memory: embedding context adds {mb(kv_cache_bytes(llm, n_ctx=512))} of KV cache")
+    print(f"Memory: each session snapshot in RAM holds up to {mb(kv)}, SESSION_CACHE_MB={SESSION_CACHE_MB}")
+    print(f"Context: shifting {'on' if CONTEXT_SHIFT else 'off'}")
+
+def load_model():
+    """Loads the model, its system prefix and the batch engine or worker pool, then warms up."""
+    global llm, embedder, prefix_state, prefix_tokens, engine, pool, offload, model_error
+    started_at = time.perf_counter()
+    try:
+        llm_params = context_params(MODEL_PATH)
+        llm = Llama(
+            model_path=MODEL_PATH, n_ctx=N_CTX, use_mmap=True, verbose=False, **llm_params, **load_tuning(MODEL_PATH)
+        )
+        log_memory_cost(llm_params)
+        registry.add(registry.default_name, llm, pinned=True)
+        prefix_state, prefix_tokens = load_prefix_state()
+        # One short generation faults the mmap'd weights into memory, so the first real request
+        # doesn't pay for the page faults
+        llm(f"{SYSTEM_PREFIX}[USER]: Hello\n[ASSISTANT]:", max_tokens=8)
+        engine = BatchEngine(BATCH_MAX_SEQUENCES) if BATCH_MAX_SEQUENCES > 1 and POOL_WORKERS < 1 else None
+        pool = WorkerPool(POOL_WORKERS, llm_params) if POOL_WORKERS >= 1 else None
+        if pool is not None:
+            pool.wait_ready(POOL_READY_TIMEOUT)
+        offload = pool or engine
+        if SEMANTIC_CACHE:
+            embedder = Llama(
+                model_path=MODEL_PATH, embedding=True, n_ctx=512, use_mmap=True, verbose=False, **load_tuning(MODEL_PATH)
+            )
+    except Exception as e:
+        model_error = str(e)
+        print(f"Model failed to load: {e}")
+        return
+    model_ready.set()
+    print(f"Model loaded and warmed up in {time.perf_counter() - started_at:.2f}s")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load in the background so /healthz answers at once and /readyz flips when the model is warm
+    scheduler.loop = asyncio.get_running_loop()
+    scheduler.loop.run_in_executor(inference_executor, load_model)
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+class GzipRequestMiddleware:
+    """Inflates request bodies sent with Content-Encoding: gzip (e.g. a long history seeding a session)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (b"content-encoding", b"gzip") not in scope["headers"]:
+            await self.app(scope, receive, send)
+            return
+        body, more_body = b"", True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        # Inflate at most one byte past the limit, so a tiny body can't expand into gigabytes
+        limit = MAX_INFLATED_BODY_MB * 1024 * 1024
+        inflater = zlib.decompressobj(wbits=31)  # gzip framing
+        try:
+            body = inflater.decompress(body, limit + 1)
+        except zlib.error:
+            await PlainTextResponse("Invalid gzip body.", status_code=400)(scope, receive, send)
+            return
+        if len(body) > limit:
+            await PlainTextResponse(f"Request body is larger than {MAX_INFLATED_BODY_MB} MB once inflated.", status_code=413)(scope, receive, send)
+            return
+        if not inflater.eof:
+            await PlainTextResponse("Invalid gzip body.", status_code=400)(scope, receive, send)
+            return
+        headers = [(name, value) for name, value in scope["headers"] if name not in (b"content-encoding", b"content-length")]
+        headers.append((b"content-length", str(len(body)).encode()))
+        body_sent = False
+
+        async def inflated_receive():
+            # The body once, then whatever comes next (the disconnect watchers wait for http.disconnect)
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app({**scope, "headers": headers}, inflated_receive, send)
+
+app.add_middleware(GzipRequestMiddleware)
+
+def generation_fn(request):
+    """Where a request is generated: the pool and batch engine only serve the default model."""
+    if offload is not None and registry.resolve(request.model) == registry.default_name:
+        return run_offloaded
+    return run_stream
+
+def run_offloaded(request, submitted_at, emit, cancel):
+    """Prepares the prompt on a prep thread, then hands it to the worker pool or batch engine.
+
+    Only a history summary, if HISTORY_SUMMARY needs a new one, waits for the llama thread.
+    """
+    try:
+        prompt, context = build_prompt(request)
+        offload.submit(prompt, generation_params(request), submitted_at, emit, cancel, context)
+    except Exception as e:
+        emit("error", {"detail": str(e)})
+        emit(None, None)
+
+class ResponseCache:
+    """Two-tier cache of generated answers: an in-memory LRU in front of a SQLite table, both with a TTL."""
+    def __init__(self, max_entries, ttl_seconds, db_path):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.memory = OrderedDict()  # key -> (created, response)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+
+    def get(self, key):
+        """Returns (response, tier) for a fresh entry, or None."""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[1], "memory"
+            self.memory.pop(key, None)
+            row = self.db.execute("SELECT created, response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[0] < self.ttl_seconds:
+                self.remember(key, row[0], row[1])
+                self.stats["disk_hits"] += 1
+                return row[1], "disk"
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock:
+            self.remember(key, now, response)
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response, now))
+            self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            self.db.commit()
+            self.stats["stores"] += 1
+
+    def remember(self, key, created, response):
+        """Adds an entry to the memory tier (caller holds the lock), evicting the least recently used."""
+        self.memory[key] = (created, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def bypass(self):
+        with self.lock:
+            self.stats["bypassed"] += 1
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB) if RESPONSE_CACHE else None
+
+class SemanticCache:
+    """Answers indexed by the normalized embedding of their message, searched by cosine similarity.
+
+    The index is one preallocated NumPy matrix, so a lookup is a single matrix-vector product;
+    when it is full the least recently used row is overwritten. Only used from the event loop.
+    """
+    def __init__(self, max_entries, threshold):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.vectors = None  # (max_entries, dim) float32, allocated on the first add
+        self.scopes = [None] * max_entries
+        self.responses = [None] * max_entries
+        self.last_used = np.zeros(max_entries)
+        self.size = 0
+        # lookup_ms counts the message's embedding too, which costs far more than the search
+        self.stats = {
+            "hits": 0, "misses": 0, "stores": 0, "evictions": 0,
+            "lookup_ms_total": 0.0, "embeds": 0, "embed_ms_total": 0.0,
+        }
+
+    def record_embedding(self, embed_ms):
+        self.stats["embeds"] += 1
+        self.stats["embed_ms_total"] += embed_ms
+
+    def lookup(self, scope, vector, embed_ms=0.0):
+        """Returns (response, similarity) of the closest earlier answer in the same scope, or None."""
+        started_at = time.perf_counter() - embed_ms / 1000
+        best = None
+        if self.size:
+            similarities = self.vectors[:self.size] @ vector
+            in_scope = np.fromiter((s == scope for s in self.scopes[:self.size]), bool, self.size)
+            similarities[~in_scope] = -1.0
+            index = int(similarities.argmax())
+            if similarities[index] >= self.threshold:
+                self.last_used[index] = time.monotonic()
+                best = self.responses[index], float(similarities[index])
+        self.stats["hits" if best else "misses"] += 1
+        self.stats["lookup_ms_total"] += (time.perf_counter() - started_at) * 1000
+        return best
+
+    def add(self, scope, vector, response):
+        if self.vectors is None:
+            self.vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+        if self.size < self.max_entries:
+            index = self.size
+            self.size += 1
+        else:
+            index = int(self.last_used.argmin())
+            self.stats["evictions"] += 1
+        self.vectors[index] = vector
+        self.scopes[index] = scope
+        self.responses[index] = response
+        self.last_used[index] = time.monotonic()
+        self.stats["stores"] += 1
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD) if SEMANTIC_CACHE else None
+
+# Embeddings run on their own context and thread, so lookups don't queue behind generations
+embed_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+
+def embed(text):
+    """Unit-length embedding of a message (mean of the token embeddings if the model has no pooling)."""
+    vector = np.asarray(embedder.embed(text), dtype=np.float32)
+    if vector.ndim > 1:
+        vector = vector.mean(axis=0)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+# Sampling settings that change the answer, part of every cache key
+CACHED_SETTINGS = ("temperature", "top_p", "top_k", "repeat_penalty", "max_tokens")
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+def cache_key(request):
+    """Hash of the whitespace-normalized prompt parts and the sampling settings that shape the answer.
+
+    Each history turn is normalized on its own, so text moved across turn boundaries changes the key.
+    """
+    # Windowing is deterministic, so the history before windowing identifies the final prompt
+    settings = {name: generation_params(request)[name] for name in CACHED_SETTINGS}
+    material = json.dumps([
+        registry.resolve(request.model),
+        normalize_text(SYSTEM_PREFIX),
+        [normalize_text(item) for item in request.history],
+        normalize_text(request.message),
+        settings,
+    ], sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def semantic_scope(request):
+    """Hash of everything but the message, so paraphrases only match answers given in the same context."""
+    settings = {name: generation_params(request)[name] for name in CACHED_SETTINGS}
+    material = json.dumps([
+        registry.resolve(request.model),
+        normalize_text(SYSTEM_PREFIX),
+        [normalize_text(item) for item in request.history],
+        settings,
+    ], sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+async def cache_lookup(request, headers):
+    """Returns (store, cached): store is what cache_store() needs to keep the answer (None if it must
+    not be stored), cached is (response, tier) on a hit.
+    """
+    if response_cache is None and semantic_cache is None:
+        return None, None
+    directives = headers.get("cache-control", "").lower()
+    if "no-store" in directives:
+        if response_cache is not None:
+            response_cache.bypass()
+        return None, None
+    # "no-cache" asks for a fresh sample, but it may still refresh the cache
+    fresh = "no-cache" in directives
+    store = {}
+    if response_cache is not None:
+        store["key"] = cache_key(request)
+        if fresh:
+            response_cache.bypass()
+        else:
+            cached = await asyncio.to_thread(response_cache.get, store["key"])
+            if cached is not None:
+                return store, cached
+    if semantic_cache is not None and embedder is not None:
+        started_at = time.perf_counter()
+        vector = await asyncio.get_running_loop().run_in_executor(embed_executor, embed, request.message)
+        embed_ms = (time.perf_counter() - started_at) * 1000
+        semantic_cache.record_embedding(embed_ms)
+        store["semantic"] = semantic_scope(request), vector
+        if not fresh:
+            hit = semantic_cache.lookup(*store["semantic"], embed_ms)
+            if hit is not None:
+                return store, (hit[0], "semantic")
+    return store, None
+
+async def cache_store(store, response):
+    """Keeps a generated answer in the caches cache_lookup() consulted."""
+    if "key" in store:
+        await asyncio.to_thread(response_cache.put, store["key"], response)
+    if "semantic" in store:
+        semantic_cache.add(*store["semantic"], response)
+
+def run_session_turn(session_id, message, cancel, submitted_at):
+    """Appends one user turn to a session, evaluating only the tokens that are new to it.
+
+    A turn cancelled because the client went away leaves the session unchanged.
+    """
+    started_at = time.perf_counter()
+    session = sessions.get(session_id)
+    if session is None:
+        return None
+    history, state = session
+    prompt, context = build_prompt(ChatRequest(history=history, message=message))
+    if state is not None:
+        llm.load_state(state)
+    else:
+        restore_prefix()
+    tokens = llm.tokenize(prompt.encode("utf-8"))
+    shifted_tokens = shift_context(tokens) if CONTEXT_SHIFT else 0
+    reused_tokens = cached_prefix_length(tokens)
+    text = ""
+    completion_tokens = 0
+    first_token_at = None
+    finish_reason = None
+    for chunk in llm(prompt, stream=True, **GENERATION_PARAMS):
+        if cancel.is_set():
+            record_cancellation(len(tokens), completion_tokens)
+            return None
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        text += chunk["choices"][0]["text"]
+        finish_reason = chunk["choices"][0].get("finish_reason") or finish_reason
+        completion_tokens += 1
+    if cancel.is_set():  # the client left, or the session was deleted, after the last token
+        record_cancellation(len(tokens), completion_tokens)
+        return None
+    finished_at = time.perf_counter()
+    text = text.strip()
+    history = history + [f"[USER]: {message}", f"[ASSISTANT]: {text}"]
+    sessions.put(session_id, history, llm.save_state())
+    timings = request_timings(submitted_at, started_at, first_token_at or finished_at, finished_at, completion_tokens)
+    observe_request(finish_reason, {"prompt_tokens": len(tokens), "completion_tokens": completion_tokens}, timings)
+    timings["prefilled_tokens"] = len(tokens) - reused_tokens
+    timings["reused_tokens"] = reused_tokens
+    timings["shifted_out_tokens"] = shifted_tokens
+    return text, timings, context
+
+class Scheduler:
+    """Admission queue in front of the llama thread, worker pool or batch engine.
+
+    Up to capacity() requests run at once and INFERENCE_QUEUE_SIZE more may wait; the rest get a
+    503. Exclusive requests (session turns, which all run on the one llama thread) also run at most
+    one at a time. Waiting requests are started in policy order:
+      fifo: arrival order.
+      sjf:  smallest estimated cost first. Long requests can wait as long as short ones keep coming.
+      fair: start-time fair queuing on estimated cost, so every client gets an equal share of
+            tokens no matter how many or how large requests it sends.
+    Only used from the event loop.
+    """
+    def __init__(self, policy, queue_size):
+        if policy not in ("fifo", "sjf", "fair"):
+            raise ValueError(f"Unknown SCHEDULER_POLICY {policy!r}")
+        self.policy = policy
+        self.queue_size = queue_size
+        self.running = 0
+        self.exclusive_running = 0
+        self.waiting = []  # heap of (priority, arrival number, future, priority, exclusive)
+        self.arrivals = itertools.count()
+        self.virtual_time = 0.0
+        self.client_tags = {}  # client -> virtual finish tag of its last request (fair)
+        self.rejected = 0
+        self.loop = None  # the event loop, for wake()
+        self.waits = {
+            job: Histogram(
+                "llm_scheduler_wait_seconds", "Time requests waited in the scheduler queue.",
+                SECONDS_BUCKETS, {"policy": policy, "job": job},
+            )
+            for job in ("short", "long")
+        }
+
+    def capacity(self):
+        if pool is not None:
+            return pool.live
+        if engine is not None:
+            return BATCH_MAX_SEQUENCES
+        return 1
+
+    def priority(self, client, cost):
+        if self.policy == "sjf":
+            return cost
+        if self.policy == "fair":
+            start = max(self.virtual_time, self.client_tags.get(client, 0.0))
+            self.client_tags[client] = start + cost
+            return start
+        return 0
+
+    def admit(self):
+        """Answers 503 if the model isn't loaded yet or the queue is full."""
+        if not model_ready.is_set():
+            raise HTTPException(
+                status_code=503,
+                detail="Model is still loading, please retry shortly.",
+                headers={"Retry-After": "5"},
+            )
+        if self.running + len(self.waiting) >= self.capacity() + self.queue_size:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Inference queue is full, please retry shortly.",
+                headers={"Retry-After": "5"},
+            )
+
+    def fits(self, exclusive):
+        return self.running < self.capacity() and not (exclusive and self.exclusive_running)
+
+    async def acquire(self, client, cost, exclusive=False):
+        """Waits for this request's turn and returns when it arrived (perf_counter), or answers 503."""
+        self.admit()
+        arrived_at = time.perf_counter()
+        priority = self.priority(client, cost)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.arrivals), future, priority, exclusive))
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just as we were cancelled
+            if future.done() and not future.cancelled():
+                self.release(exclusive)
+            else:
+                self.waiting = [entry for entry in self.waiting if entry[2] is not future]
+                heapq.heapify(self.waiting)
+            raise
+        with metrics_lock:
+            self.waits["short" if cost <= SHORT_JOB_COST else "long"].observe(time.perf_counter() - arrived_at)
+        return arrived_at
+
+    def release(self, exclusive=False):
+        """Frees a running slot and starts the next waiting requests."""
+        self.running -= 1
+        self.exclusive_running -= exclusive
+        self.dispatch()
+
+    def wake(self):
+        """Starts waiting requests after capacity() grew; safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.dispatch)
+
+    def dispatch(self):
+        """Starts waiting requests in priority order while they fit."""
+        blocked = []  # exclusive requests that must wait for the running one
+        while self.waiting and self.running < self.capacity():
+            entry = heapq.heappop(self.waiting)
+            _, _, future, priority, exclusive = entry
+            if not self.fits(exclusive):
+                blocked.append(entry)
+                continue
+            self.running += 1
+            self.exclusive_running += exclusive
+            self.virtual_time = max(self.virtual_time, priority)
+            future.set_result(None)
+        for entry in blocked:
+            heapq.heappush(self.waiting, entry)
+
+scheduler = Scheduler(SCHEDULER_POLICY, INFERENCE_QUEUE_SIZE)
+
+def client_key(http_request):
+    """Who a request is from, for fair sharing: its API key if it sent one, else its IP address."""
+    authorization = http_request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return "key:" + hashlib.sha1(authorization[7:].encode("utf-8")).hexdigest()
+    if "x-api-key" in http_request.headers:
+        return "key:" + hashlib.sha1(http_request.headers["x-api-key"].encode("utf-8")).hexdigest()
+    return "ip:" + (http_request.client.host if http_request.client else "unknown")
+
+def estimated_cost(request):
+    """Rough token cost of a request: prompt tokens (about 4 characters each, at most the context)
+    plus its max_tokens.
+    """
+    chars = len(SYSTEM_PREFIX) + len(request.message) + sum(len(item) + 1 for item in request.history)
+    return min(chars // 4, N_CTX) + generation_params(request)["max_tokens"]
+
+async def submit_inference(client, cost, fn, *args):
+    """Runs fn(*args, submitted_at) on the inference thread once the scheduler lets it."""
+    submitted_at = await scheduler.acquire(client, cost, exclusive=True)
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(inference_executor, fn, *args, submitted_at)
+    finally:
+        scheduler.release(exclusive=True)
+
+async def stream_events(fn, request, cancel, submitted_at):
+    """Runs fn(request, submitted_at, emit, cancel) in the background and yields the (event, data) it emits.
+
+    Offloaded requests only prepare their prompt there; everything else runs on the inference thread.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    executor = prep_executor if fn is run_offloaded else inference_executor
+    loop.run_in_executor(executor, fn, request, submitted_at, emit, cancel)
+    while True:
+        event, data = await events.get()
+        if event is None:
+            return
+        if event == "done":
+            observe_request(data["finish_reason"], data["usage"], data["timings"])
+        yield event, data
+
+async def watch_disconnect(http_request, cancel):
+    """Sets cancel as soon as the client of a non-streaming request disconnects."""
+    while not cancel.is_set():
+        if await http_request.is_disconnected():
+            cancel.set()
+            return
+        await asyncio.sleep(0.25)
+
+def check_model(request):
+    """Answers 404 for a model that is not in the models directory."""
+    try:
+        registry.resolve(request.model)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model: {request.model}")
+
+def sse_event(event, data):
+    """Formats one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/chat")
+async def chat(request: ChatRequest, http_request: Request, response: Response):
+    check_model(request)
+    store, cached = await cache_lookup(request, http_request.headers)
+    if cached is not None:
+        response.headers["Server-Timing"] = f'cache;desc="{cached[1]}"'
+        return {"response": cached[0], "cache": cached[1]}
+
+    result = await generate(request, http_request)
+    response.headers["Server-Timing"] = server_timing(result)
+
+    if store is not None:
+        if result["response"] != "Error: No output from AI":
+            await cache_store(store, result["response"])
+        result["cache"] = "miss"
+    return result
+
+async def generate(request, http_request):
+    """Runs one generation to completion and builds the /chat JSON answer from its events.
+
+    The client is watched while it waits, so a disconnect stops generation at the next token.
+    """
+    cancel = threading.Event()
+    watcher = asyncio.create_task(watch_disconnect(http_request, cancel))
+    try:
+        submitted_at = await scheduler.acquire(client_key(http_request), estimated_cost(request))
+        try:
+            text, done = "", None
+            async for event, data in stream_events(generation_fn(request), request, cancel, submitted_at):
+                if event == "token":
+                    text += data["token"]
+                elif event == "done":
+                    done = data
+                elif event == "error":
+                    raise HTTPException(status_code=500, detail=data["detail"])
+        finally:
+            scheduler.release()
+    finally:
+        watcher.cancel()
+    # A cancelled generation still reports usage, but its text is cut short: never a result
+    if done is None or done["finish_reason"] == "cancelled":
+        raise HTTPException(status_code=499, detail="Client disconnected.")
+    text = text.strip()
+    return {"response": text if text else "Error: No output from AI", **done["timings"], "usage": done["usage"], "context": done["context"]}
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """Same as /chat, but sends each token as an SSE "token" event and finishes with a "done" event.
+
+    Headers go out before generation starts, so the timing breakdown is in the "done" event.
+    """
+    check_model(request)
+    store, cached = await cache_lookup(request, http_request.headers)
+    if cached is not None:
+        async def cached_stream():
+            yield sse_event("token", {"token": cached[0]})
+            yield sse_event("done", {"finish_reason": "stop", "cache": cached[1]})
+
+        return StreamingResponse(
+            cached_stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "Server-Timing": f'cache;desc="{cached[1]}"'},
+        )
+
+    scheduler.admit()  # 503 now, while there is still a status code to send
+    cancel = threading.Event()
+
+    async def event_stream():
+        # The slot is taken inside the stream: if the client leaves before Starlette starts it,
+        # nothing was acquired, whereas a slot taken in the endpoint would never be released
+        try:
+            submitted_at = await scheduler.acquire(client_key(http_request), estimated_cost(request))
+        except HTTPException as e:
+            yield sse_event("error", {"detail": e.detail})
+            return
+        text = ""
+        try:
+            async for event, data in stream_events(generation_fn(request), request, cancel, submitted_at):
+                if event == "token":
+                    text += data["token"]
+                elif event == "done" and store is not None:
+                    if text.strip() and data["finish_reason"] != "cancelled":
+                        await cache_store(store, text.strip())
+                    data["cache"] = "miss"
+                yield sse_event(event, data)
+        finally:
+            # Runs when the stream ends and when Starlette cancels it because the client left
+            cancel.set()
+            scheduler.release()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-    text = response["choices"][0]["text"].strip()
-    return {"response": text if text else "Error: No output from AI"}
+@app.get("/cache/stats")
+async def cache_stats():
+    stats = {"enabled": response_cache is not None}
+    if response_cache is not None:
+        stats.update(memory_entries=len(response_cache.memory), **response_cache.stats)
+    if semantic_cache is not None:
+        lookups = semantic_cache.stats["hits"] + semantic_cache.stats["misses"]
+        stats["semantic"] = {
+            "entries": semantic_cache.size,
+            "threshold": semantic_cache.threshold,
+            **semantic_cache.stats,
+            "lookup_ms_avg": round(semantic_cache.stats["lookup_ms_total"] / lookups, 3) if lookups else None,
+            "embed_ms_avg": (
+                round(semantic_cache.stats["embed_ms_total"] / semantic_cache.stats["embeds"], 3)
+                if semantic_cache.stats["embeds"] else None
+            ),
+        }
+    return stats
+
+@app.get("/cancel/stats")
+async def cancellation_stats():
+    with cancel_stats_lock:
+        return dict(cancel_stats)
+
+@app.get("/models")
+async def models():
+    """Models in the models directory, which are loaded and how much memory they take, and recent loads/evictions."""
+    return registry.snapshot()
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving HTTP, whether or not the model is loaded."""
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: the model is loaded and warmed up, so requests will be served at full speed."""
+    if model_ready.is_set() and pool is not None and not pool.live:
+        raise HTTPException(status_code=503, detail="No llama worker is running, restarting them.", headers={"Retry-After": "5"})
+    if model_ready.is_set():
+        return {"status": "ready"}
+    if model_error is not None:
+        raise HTTPException(status_code=503, detail=f"Model failed to load: {model_error}")
+    raise HTTPException(status_code=503, detail="Model is still loading.", headers={"Retry-After": "2"})
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of the per-request timings and token counts."""
+    with metrics_lock:
+        lines = [histogram.render() for histogram in histograms.values()]
+        lines.append("# HELP llm_requests_total Finished generations by finish reason.")
+        lines.append("# TYPE llm_requests_total counter")
+        for reason, count in sorted(finished_requests.items(), key=lambda item: str(item[0])):
+            lines.append(f'llm_requests_total{{finish_reason="{reason}"}} {count}')
+    snapshot = registry.snapshot()
+    lines.append("# HELP llm_model_resident_bytes Estimated memory of each loaded model (weights plus KV cache).")
+    lines.append("# TYPE llm_model_resident_bytes gauge")
+    for model in snapshot["models"]:
+        if model["loaded"]:
+            lines.append(f'llm_model_resident_bytes{{model="{model["name"]}"}} {model["resident_bytes"]}')
+    lines.append("# TYPE llm_model_loads_total counter")
+    lines.append(f"llm_model_loads_total {snapshot['loads']}")
+    lines.append("# TYPE llm_model_evictions_total counter")
+    lines.append(f"llm_model_evictions_total {snapshot['evictions']}")
+    with metrics_lock:
+        lines += [histogram.render(header=i == 0) for i, histogram in enumerate(scheduler.waits.values())]
+    policy = f'policy="{scheduler.policy}"'
+    lines.append("# HELP llm_scheduler_running Requests generating.")
+    lines.append("# TYPE llm_scheduler_running gauge")
+    lines.append(f"llm_scheduler_running{{{policy}}} {scheduler.running}")
+    lines.append("# HELP llm_scheduler_queue_depth Requests waiting for the model.")
+    lines.append("# TYPE llm_scheduler_queue_depth gauge")
+    lines.append(f"llm_scheduler_queue_depth{{{policy}}} {len(scheduler.waiting)}")
+    lines.append("# HELP llm_scheduler_rejected_total Requests answered 503 because the queue was full.")
+    lines.append("# TYPE llm_scheduler_rejected_total counter")
+    lines.append(f"llm_scheduler_rejected_total{{{policy}}} {scheduler.rejected}")
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.post("/sessions")
+async def create_session(request: SessionCreateRequest):
+    """Starts a server-side chat session, optionally seeded with earlier turns."""
+    return {"session_id": await asyncio.to_thread(sessions.create, list(request.history))}
+
+# Sessions with a turn in progress and the event that cancels it; a second turn would start from
+# the same saved state and one of the two answers would be lost
+active_turns = {}
+
+@app.post("/sessions/{session_id}/messages")
+async def session_message(session_id: str, request: SessionMessageRequest, http_request: Request, response: Response):
+    """Sends the next user message of a session; only the new turn is prefilled."""
+    if session_id in active_turns:
+        raise HTTPException(status_code=409, detail="Another message of this session is still being answered.")
+    cancel = active_turns[session_id] = threading.Event()
+    try:
+        session = await asyncio.to_thread(sessions.get, session_id)  # may load a spilled session from disk
+        if session is None:
+            raise HTTPException(status_code=404, detail="Unknown session.")
+        watcher = asyncio.create_task(watch_disconnect(http_request, cancel))
+        try:
+            # The turn's prompt holds the stored history too, not just the new message
+            cost = estimated_cost(ChatRequest(history=session[0], message=request.message))
+            result = await submit_inference(client_key(http_request), cost, run_session_turn, session_id, request.message, cancel)
+        finally:
+            watcher.cancel()
+    finally:
+        del active_turns[session_id]
+    if cancel.is_set():
+        raise HTTPException(status_code=499, detail="Client disconnected.")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Unknown session.")
+    text, timings, context = result
+    response.headers["Server-Timing"] = server_timing(timings)
+    return {"response": text if text else "Error: No output from AI", "session_id": session_id, **timings, "context": context}
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if session_id in active_turns:
+        active_turns[session_id].set()  # otherwise the turn would store the session again
+    if not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Unknown session.")
+    return {"deleted": session_id}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,101 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from llama_cpp import Llama
+
+# Worker process for the backend's pool mode (POOL_WORKERS). It loads the GGUF with mmap, so
+# every worker maps the same page-cached weights, then serves jobs read as JSON lines on stdin
+# and writes its token/done/error events as JSON lines on stdout. A {"cancel": <job id>} line
+# stops that job at its next token.
+#
+# Usage: python llama_worker.py <model_path> <n_ctx> <comma separated cpu ids> [<json Llama params>]
+
+def batch_tuning(model_path):
+    """n_batch / n_ubatch from the model's autotune.py file; the thread count comes from the cpu slice."""
+    path = model_path + ".tuning.json"
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        tuning = json.load(f)
+    if tuning.get("cpu_count") != os.cpu_count():
+        return {}
+    return {name: tuning[name] for name in ("n_batch", "n_ubatch") if name in tuning}
+
+def send(message):
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+def read_stdin(jobs, cancelled):
+    """Queues incoming jobs and records cancellations while the main thread is generating."""
+    for line in sys.stdin:
+        message = json.loads(line)
+        if "cancel" in message:
+            cancelled.add(message["cancel"])
+        else:
+            jobs.put(message)
+    jobs.put(None)
+
+def run_job(llm, job, cancelled):
+    """Streams one completion, reporting usage and timings measured inside the worker."""
+    started_at = time.perf_counter()
+    first_token_at = None
+    completion_tokens = 0
+    finish_reason = None
+    try:
+        for chunk in llm(job["prompt"], stream=True, **job["params"]):
+            if job["id"] in cancelled:
+                finish_reason = "cancelled"
+                break
+            choice = chunk["choices"][0]
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            completion_tokens += 1
+            finish_reason = choice.get("finish_reason") or finish_reason
+            if choice["text"]:
+                send({"event": "token", "data": {"token": choice["text"]}})
+        finished_at = time.perf_counter()
+        first_token_at = first_token_at or finished_at
+        decode_seconds = finished_at - first_token_at
+        prompt_tokens = len(llm.tokenize(job["prompt"].encode("utf-8")))
+        send({"event": "done", "data": {
+            "finish_reason": finish_reason,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+            "timings": {
+                "prompt_eval_ms": round((first_token_at - started_at) * 1000, 1),
+                "inference_ms": round((finished_at - started_at) * 1000, 1),
+                "tokens_per_second": round(completion_tokens / decode_seconds, 2) if decode_seconds > 0 else None,
+            },
+        }})
+    except Exception as e:
+        send({"event": "error", "data": {"detail": str(e)}})
+    finally:
+        cancelled.discard(job["id"])
+
+def main():
+    model_path, n_ctx, cpus = sys.argv[1], int(sys.argv[2]), [int(cpu) for cpu in sys.argv[3].split(",")]
+    # KV cache type, RoPE scaling and the like, as the backend configured its own context
+    params = json.loads(sys.argv[4]) if len(sys.argv) > 4 else {}
+    # Pin the worker to its own slice of cores so workers don't fight over the same ones
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    llm = Llama(
+        model_path=model_path, n_ctx=n_ctx, n_threads=len(cpus), use_mmap=True, verbose=False,
+        **params, **batch_tuning(model_path),
+    )
+    llm("Hello", max_tokens=8)  # fault in the mmap'd weights before reporting ready
+    send({"event": "ready", "data": {"pid": os.getpid(), "cpus": cpus}})
+    jobs = queue.Queue()
+    cancelled = set()
+    threading.Thread(target=read_stdin, args=(jobs, cancelled), daemon=True).start()
+    for job in iter(jobs.get, None):
+        run_job(llm, job, cancelled)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+from llama_cpp import Llama
+from speculative import make_draft_model
+import argparse
+import json
+import os
+import time
+
+# Compares decode throughput of the normal path against the speculative modes on the same prompts.
+#
+#   python bench_speculative.py
+#   python bench_speculative.py --draft-model models/<smaller model>.gguf --check
+#
+# --check reruns every prompt greedily and verifies each mode produces exactly the same text
+# as the normal path, i.e. the drafts never change what the model would have said.
+
+MODEL_PATH = os.path.abspath("models/tinyllama-1.1b-chat-v1.0.Q2_K.gguf")
+
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant. Answer questions concisely and professionally."
+    "Provide responses short and simple. Avoid technical and complex answers."
+    "Ensure responses are relevant to the user's question."
+    "Always provide clear and accurate information."
+)
+
+# A mix of open questions and prompts that repeat their input, where prompt lookup shines
+PROMPTS = [
+    "Who is Elon Musk?",
+    "Explain what a CPU cache is in a few sentences.",
+    "Write a short Python function that reverses a string.",
+    "Rewrite this sentence in the past tense: The team ships a new release every Friday and "
+    "the users download it on Monday.",
+    "Summarize: The quick brown fox jumps over the lazy dog. The lazy dog does not react. "
+    "The quick brown fox jumps over the lazy dog again.",
+]
+
+SAMPLING = dict(temperature=0.5, top_p=0.5, top_k=50, repeat_penalty=1.1, stop=["[USER]:", "\n[ASSISTANT]:"])
+
+def run_mode(mode, args, prompts, greedy):
+    """Loads the model with the given speculative mode and times every prompt."""
+    draft = make_draft_model(mode, args.draft_tokens, args.draft_model, args.n_ctx)
+    llm = Llama(model_path=args.model, n_ctx=args.n_ctx, use_mmap=True, verbose=False, draft_model=draft)
+    sampling = dict(SAMPLING, temperature=0.0) if greedy else SAMPLING
+    llm("Hello", max_tokens=8)  # warm up: fault in the mmap'd weights
+    results = []
+    for prompt in prompts:
+        full_prompt = f"[SYSTEM]: {SYSTEM_PROMPT}\n[USER]: {prompt}\n[ASSISTANT]:"
+        llm.reset()
+        started_at = time.perf_counter()
+        response = llm(full_prompt, max_tokens=args.max_tokens, seed=args.seed, **sampling)
+        elapsed = time.perf_counter() - started_at
+        tokens = response["usage"]["completion_tokens"]
+        results.append({
+            "prompt": prompt,
+            "completion_tokens": tokens,
+            "seconds": round(elapsed, 3),
+            "tokens_per_second": round(tokens / elapsed, 2) if elapsed > 0 else None,
+            "text": response["choices"][0]["text"],
+        })
+    total_tokens = sum(r["completion_tokens"] for r in results)
+    total_seconds = sum(r["seconds"] for r in results)
+    return {
+        "mode": mode or "off",
+        "completion_tokens": total_tokens,
+        "seconds": round(total_seconds, 3),
+        "tokens_per_second": round(total_tokens / total_seconds, 2) if total_seconds > 0 else None,
+        "prompts": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare tokens/sec with and without speculative decoding.")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--draft-model", default="", help="smaller GGUF for the 'draft' mode (skipped if not given)")
+    parser.add_argument("--draft-tokens", type=int, default=10)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--n-ctx", type=int, default=2048)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--check", action="store_true", help="run greedily and verify outputs match the normal path")
+    parser.add_argument("--output", help="write the full results as JSON to this file")
+    args = parser.parse_args()
+
+    modes = ["", "prompt_lookup"] + (["draft"] if args.draft_model else [])
+    runs = [run_mode(mode, args, PROMPTS, greedy=args.check) for mode in modes]
+
+    baseline = runs[0]["tokens_per_second"]
+    print(f"{'mode':<15}{'tokens':>8}{'seconds':>10}{'tok/s':>10}{'speedup':>10}")
+    for run in runs:
+        speedup = run["tokens_per_second"] / baseline if baseline and run["tokens_per_second"] else 0
+        print(f"{run['mode']:<15}{run['completion_tokens']:>8}{run['seconds']:>10.2f}"
+              f"{run['tokens_per_second'] or 0:>10.2f}{speedup:>9.2f}x")
+
+    if args.check:
+        for run in runs[1:]:
+            mismatches = [
+                r["prompt"] for r, base in zip(run["prompts"], runs[0]["prompts"]) if r["text"] != base["text"]
+            ]
+            print(f"{run['mode']}: {'outputs identical' if not mismatches else f'MISMATCH on {mismatches}'}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(runs, f, indent=2)
+
+if __name__ == "__main__":
+    main()
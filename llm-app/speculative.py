@@ -0,0 +1,41 @@
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+import numpy as np
+
+# Speculative decoding for the llama_cpp backend. A draft proposes several tokens, the main
+# model checks them all in one forward pass and keeps the ones its own sampler agrees with, so
+# the output is what normal sampling would give, just with fewer memory-bound decode steps.
+#
+#   "prompt_lookup" - drafts by matching the last n-gram against earlier tokens (no extra model)
+#   "draft"         - drafts greedily with a smaller GGUF that shares the main model's vocabulary
+#
+# Passing any draft_model makes llama_cpp keep the logits of every position, an extra
+# n_ctx x n_vocab float32 buffer (250 MB at n_ctx 2048 with a 32000-token vocabulary).
+
+class LlamaSmallModelDraft(LlamaDraftModel):
+    """Draft model that proposes tokens by greedy decoding with a smaller GGUF."""
+    def __init__(self, model_path, num_pred_tokens=10, n_ctx=2048):
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, use_mmap=True, verbose=False)
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = []
+        # generate() reuses the longest prefix already in the draft's KV cache, so each call
+        # only evaluates the tokens accepted since the previous one
+        for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0):
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+def make_draft_model(mode, num_pred_tokens=10, draft_model_path=None, n_ctx=2048):
+    """Builds the draft_model argument for Llama(...) for a SPECULATIVE mode ("" disables it)."""
+    if not mode:
+        return None
+    if mode == "prompt_lookup":
+        return LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens)
+    if mode == "draft":
+        if not draft_model_path:
+            raise ValueError("Speculative mode 'draft' needs a draft model path")
+        return LlamaSmallModelDraft(draft_model_path, num_pred_tokens=num_pred_tokens, n_ctx=n_ctx)
+    raise ValueError(f"Unknown speculative mode: {mode!r}")
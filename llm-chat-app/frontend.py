@@ -2,7 +2,9 @@ import tkinter as tk
 from tkinter import messagebox
 import ttkbootstrap as tb
 from ttkbootstrap.constants import *
-import requests
+import httpx
+import asyncio
+import gzip
 import os
 import threading
 from PIL import Image, ImageTk
@@ -13,11 +15,340 @@ import time
 import torch
 import whisper
 import pyaudio
-import wave
+import numpy as np
 import json
+import queue
+import bisect
+import math
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Backend API URL
 API_URL = "http://127.0.0.1:8000/chat"
+SESSIONS_URL = "http://127.0.0.1:8000/sessions"
+
+# Seconds to wait for the backend to accept a connection, and for a whole answer
+CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", "5"))
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "300"))
+# Request bodies at least this large (e.g. a long history seeding a session) are sent gzip-compressed
+GZIP_MIN_BYTES = int(os.environ.get("GZIP_MIN_BYTES", "4096"))
+
+class NetworkLoop:
+    """One asyncio loop on a background thread, with a keep-alive HTTP client shared by every request.
+
+    Coroutines are submitted from the Tk thread and their results are handed back through Tk's
+    after() queue, so widgets are only touched on the Tk thread.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.latencies = deque(maxlen=100)  # milliseconds, most recent requests
+        started = threading.Event()
+        threading.Thread(target=self.run, args=(started,), daemon=True).start()
+        started.wait()
+
+    def run(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4, keepalive_expiry=120),
+        )
+        started.set()
+        self.loop.run_forever()
+
+    def submit(self, coro, on_done):
+        """Runs coro on the loop and calls on_done(result, error) on the Tk thread; cancel() the returned future to stop it."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        def done(future):
+            if future.cancelled():
+                self.root.after(0, on_done, None, asyncio.CancelledError())
+            else:
+                self.root.after(0, on_done, future.result() if future.exception() is None else None, future.exception())
+
+        future.add_done_callback(done)
+        return future
+
+    async def post_json(self, url, payload):
+        """POSTs payload as JSON, gzipped when it is large, and records how long the answer took."""
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        started_at = time.perf_counter()
+        response = await self.client.post(url, content=body, headers=headers)
+        latency_ms = (time.perf_counter() - started_at) * 1000
+        self.latencies.append(latency_ms)
+        median = sorted(self.latencies)[len(self.latencies) // 2]
+        print(f"POST {url} -> {response.status_code} in {latency_ms:.0f} ms, {len(body)} bytes sent "
+              f"(median of last {len(self.latencies)}: {median:.0f} ms)")
+        return response
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# Rendered chat bubbles kept in memory, keyed by a hash of the message text
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "512"))
+
+render_cache = OrderedDict()
+# Markdown is converted here so long answers don't freeze the window; one worker keeps messages in order
+render_executor = ThreadPoolExecutor(max_workers=1)
+
+def render_markdown(message):
+    """Styled bubble HTML for a message, memoized by content hash (only called on render_executor)."""
+    key = hashlib.sha256(message.encode("utf-8")).digest()
+    if key in render_cache:
+        render_cache.move_to_end(key)
+        return render_cache[key]
+    html_content = markdown.markdown(message, extensions=["fenced_code", "tables"])
+    styled_html = f"""
+    <div style="color: #ffffff; font-family: Arial, sans-serif; font-size: 14px; border-radius: 10px; padding: 10px;">
+        {html_content}
+    </div>
+    """
+    render_cache[key] = styled_html
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        render_cache.popitem(last=False)
+    return styled_html
+
+# Whisper works on 16 kHz mono audio
+SAMPLE_RATE = 16000
+
+def frames_to_audio(frames):
+    """Recorded 16-bit PCM frames as the float32 array in [-1, 1) Whisper takes (no WAV file, no ffmpeg)."""
+    return np.frombuffer(b"".join(frames), dtype=np.int16).astype(np.float32) / 32768.0
+
+# Live transcription: the mic stream is cut into segments at pauses and each one is transcribed
+# while the user keeps talking (0 transcribes the whole recording after Stop instead)
+LIVE_TRANSCRIPTION = os.environ.get("LIVE_TRANSCRIPTION", "1") == "1"
+# Voice activity detection works on frames of this length
+VAD_FRAME_MS = 30
+# The noise floor starts as a low percentile of the frames in this first stretch of the recording
+VAD_CALIBRATION_MS = 1000
+# Frames quieter than this never count as speech, however low the noise floor is
+VAD_MIN_DBFS = float(os.environ.get("VAD_MIN_DBFS", "-50"))
+# A segment closes after this much silence, or once it is this long
+VAD_SILENCE_MS = int(os.environ.get("VAD_SILENCE_MS", "500"))
+VAD_MAX_SEGMENT_S = float(os.environ.get("VAD_MAX_SEGMENT_S", "15"))
+# Segments with less speech than this are dropped (clicks, breaths)
+VAD_MIN_SPEECH_MS = 200
+# Quiet audio kept in front of a segment so the first syllable isn't clipped
+VAD_PADDING_MS = 300
+
+class SpeechSegmenter:
+    """Energy-based voice activity detection over a 16 kHz float32 stream.
+
+    A frame counts as speech when its RMS is well above the tracked noise floor (and above
+    VAD_MIN_DBFS). The floor is calibrated on the first VAD_CALIBRATION_MS of audio, whose frames
+    are then classified like the rest. feed() returns the segments that closed: speech plus the
+    silence that ended it.
+    """
+
+    def __init__(self):
+        self.frame = SAMPLE_RATE * VAD_FRAME_MS // 1000
+        self.pending = np.zeros(0, dtype=np.float32)  # samples short of a whole frame
+        self.noise = None
+        self.min_rms = 10 ** (VAD_MIN_DBFS / 20)
+        self.calibration = []  # frames seen before the noise floor is known
+        self.padding = deque(maxlen=VAD_PADDING_MS // VAD_FRAME_MS)
+        self.segment = []  # frames of the open segment
+        self.speech_frames = 0
+        self.silent_frames = 0
+
+    def feed(self, samples):
+        samples = np.concatenate([self.pending, samples])
+        whole = len(samples) // self.frame * self.frame
+        self.pending = samples[whole:]
+        frames = samples[:whole].reshape(-1, self.frame)
+        if self.noise is None:
+            self.calibration.extend(frames)
+            if len(self.calibration) * VAD_FRAME_MS < VAD_CALIBRATION_MS:
+                return []
+            frames, self.calibration = np.array(self.calibration), []
+            # A low percentile finds the pauses even when the user is already talking at the start
+            self.noise = float(np.percentile(np.sqrt(np.mean(frames ** 2, axis=1)), 10))
+        closed = []
+        for frame in frames:
+            rms = float(np.sqrt(np.mean(frame ** 2)))
+            speech = rms > max(3 * self.noise, self.min_rms)
+            # The floor drops at once and rises slowly, so speech doesn't drag it up
+            if rms < self.noise:
+                self.noise = rms
+            elif not speech:
+                self.noise = 0.98 * self.noise + 0.02 * rms
+            if self.segment:
+                self.segment.append(frame)
+                self.speech_frames += speech
+                self.silent_frames = 0 if speech else self.silent_frames + 1
+                if self.silent_frames * VAD_FRAME_MS >= VAD_SILENCE_MS or len(self.segment) * VAD_FRAME_MS >= VAD_MAX_SEGMENT_S * 1000:
+                    closed.append(self.close())
+            elif speech:
+                self.segment = list(self.padding) + [frame]
+                self.speech_frames, self.silent_frames = 1, 0
+            else:
+                self.padding.append(frame)
+        return [segment for segment in closed if segment is not None]
+
+    def close(self):
+        segment = np.concatenate(self.segment) if self.speech_frames * VAD_FRAME_MS >= VAD_MIN_SPEECH_MS else None
+        self.segment = []
+        self.padding.clear()
+        return segment
+
+    def flush(self):
+        """The segment still open when the stream ends, or None."""
+        # Stopped before calibration finished: the caller falls back to the whole recording
+        if not self.segment:
+            return None
+        self.segment.append(self.pending)
+        self.pending = np.zeros(0, dtype=np.float32)
+        return self.close()
+
+# Pixels above and below the viewport whose chat bubbles are kept as widgets
+MESSAGE_OVERSCAN = 600
+# Space between two chat bubbles
+MESSAGE_GAP = 10
+
+class MessageList:
+    """Virtualized chat view on a canvas.
+
+    Messages are kept as data and only the bubbles near the viewport exist as widgets; bubbles that
+    scroll out of view are recycled for the ones scrolling in. Each message's height is measured the
+    first time it is shown and cached (it is estimated from the text until then), so scrolling and
+    resizing cost the same for 10 messages as for 10,000.
+    """
+
+    def __init__(self, canvas, scrollbar, user_icon, ai_icon):
+        self.canvas = canvas
+        self.scrollbar = scrollbar
+        self.icons = {"User": user_icon, "AI": ai_icon}
+        self.messages = []  # (sender, styled html)
+        self.render_ms = []  # time spent converting each message's Markdown, off the Tk thread
+        self.measured = []  # whether the height of each message is measured or only estimated
+        self.offsets = [0]  # top of each message; offsets[-1] is the height of the whole list
+        self.visible = {}  # message index -> bubble showing it
+        self.free = {"User": [], "AI": []}  # recycled bubbles, per layout
+        self.refresh_pending = False
+        self.refreshing = False  # inside layout(), whose update_idletasks() can run a queued refresh
+        self.refresh_again = False
+        canvas.configure(yscrollcommand=self.on_scroll)
+        canvas.bind("<Configure>", self.on_resize)
+
+    def append(self, sender, message, html, render_ms=0.0):
+        """Adds a message at the bottom and scrolls to it."""
+        # Estimate from the wrapped line count (the bubble is 80 characters wide)
+        lines = sum(max(1, math.ceil(len(line) / 80)) for line in message.split("\n"))
+        self.messages.append((sender, html))
+        self.render_ms.append(render_ms)
+        self.measured.append(False)
+        self.offsets.append(self.offsets[-1] + 30 + 20 * lines + MESSAGE_GAP)
+        self.update_scroll_region()
+        self.canvas.yview_moveto(1.0)
+        self.refresh()
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.schedule_refresh()
+
+    def on_resize(self, event):
+        # The scroll region spans the canvas width, which just changed
+        self.update_scroll_region()
+        self.refresh()
+
+    def schedule_refresh(self):
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            self.canvas.after_idle(self.refresh)
+
+    def update_scroll_region(self):
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), self.offsets[-1]))
+
+    def refresh(self):
+        """Lays out the bubbles around the viewport, one refresh at a time."""
+        self.refresh_pending = False
+        if self.refreshing:
+            # Called from update_idletasks() inside layout(): go again once it is done
+            self.refresh_again = True
+            return
+        self.refreshing = True
+        try:
+            self.layout()
+        finally:
+            self.refreshing = False
+        if self.refresh_again:
+            self.refresh_again = False
+            self.schedule_refresh()
+
+    def layout(self):
+        """Materializes the bubbles overlapping the viewport and recycles the rest."""
+        top = self.canvas.canvasy(0)
+        at_bottom = self.canvas.yview()[1] >= 1.0
+        first = max(0, bisect.bisect_right(self.offsets, top - MESSAGE_OVERSCAN) - 1)
+        last = min(len(self.messages), bisect.bisect_left(self.offsets, top + self.canvas.winfo_height() + MESSAGE_OVERSCAN))
+        for index in [i for i in self.visible if not first <= i < last]:
+            bubble = self.visible.pop(index)
+            self.canvas.itemconfigure(bubble["item"], state="hidden")
+            self.free[bubble["sender"]].append(bubble)
+        shown = [i for i in range(first, last) if i not in self.visible]
+        widget_ms = {index: self.show(index) for index in shown}
+        if shown:
+            # Measure the bubbles shown for the first time and move everything below them
+            self.canvas.update_idletasks()
+            anchor = max(0, bisect.bisect_right(self.offsets, top) - 1)
+            anchor_offset = self.offsets[anchor]
+            changed = False
+            for index in shown:
+                if not self.measured[index]:
+                    self.measured[index] = True
+                    print(f"Bubble {index}: markdown {self.render_ms[index]:.1f} ms, widgets {widget_ms[index]:.1f} ms")
+                    height = self.visible[index]["frame"].winfo_reqheight() + MESSAGE_GAP
+                    delta = height - (self.offsets[index + 1] - self.offsets[index])
+                    if delta:
+                        changed = True
+                        for i in range(index + 1, len(self.offsets)):
+                            self.offsets[i] += delta
+            if changed:
+                self.update_scroll_region()
+                # Keep the message at the top of the viewport where it was (or stay at the bottom)
+                if at_bottom:
+                    self.canvas.yview_moveto(1.0)
+                elif self.offsets[-1]:
+                    self.canvas.yview_moveto((top + self.offsets[anchor] - anchor_offset) / self.offsets[-1])
+        width = self.canvas.winfo_width()
+        for index, bubble in self.visible.items():
+            x = width - 5 if bubble["sender"] == "User" else 5
+            self.canvas.coords(bubble["item"], x, self.offsets[index] + MESSAGE_GAP // 2)
+
+    def show(self, index):
+        """Puts message index into a recycled bubble of its sender's layout, or a new one."""
+        started_at = time.perf_counter()
+        sender, html = self.messages[index]
+        bubble = self.free[sender].pop() if self.free[sender] else self.create_bubble(sender)
+        bubble["label"].set_html(html)
+        bubble["label"].fit_height()
+        self.canvas.itemconfigure(bubble["item"], state="normal")
+        self.visible[index] = bubble
+        return (time.perf_counter() - started_at) * 1000
+
+    def create_bubble(self, sender):
+        container = tk.Frame(self.canvas, bg='#2d2d2d')
+        msg_frame = tk.Frame(container, bg='#2d2d2d')
+        msg_frame.pack(side='right' if sender == "User" else 'left', anchor='ne' if sender == "User" else 'nw')
+        if sender == "User" and self.icons["User"]:
+            tk.Label(msg_frame, image=self.icons["User"], bg='#2d2d2d').pack(side='right', padx=(5, 0))
+        bubble_frame = tk.Frame(msg_frame, bg="#0d6efd" if sender == "User" else "#6c757d")
+        bubble_frame.pack(side='right' if sender == "User" else 'left')
+        bubble_label = HTMLLabel(bubble_frame, html="", background="#0d6efd" if sender == "User" else "#6c757d", width=80)
+        bubble_label.pack(side='right' if sender == "User" else 'left', padx=10, pady=5)
+        if sender == "AI" and self.icons["AI"]:
+            tk.Label(msg_frame, image=self.icons["AI"], bg='#2d2d2d').pack(side='left', padx=(0, 5))
+        item = self.canvas.create_window(0, 0, window=container, anchor='ne' if sender == "User" else 'nw')
+        return {"sender": sender, "frame": container, "label": bubble_label, "item": item}
 
 class ChatbotApp(tb.Window):
     def __init__(self):
@@ -36,20 +367,29 @@ class ChatbotApp(tb.Window):
             Image.open("assets/robot_icon.png").resize(icon_size, Image.LANCZOS)
         ) if os.path.exists("assets/robot_icon.png") else None
 
-        self.message_count = 0
-
         # Conversation history (each entry is already formatted, e.g. "[USER]: Hi")
         self.conversation_history = []
+        # Server-side session holding the conversation's llama state (created on first message)
+        self.session_id = None
+        # Requests to the backend run on one asyncio loop; pending_response is the one Stop cancels
+        self.network = NetworkLoop(self)
+        self.pending_response = None
 
         # Voice-based input using Whisper
         self.is_recording = False
-        self.audio_file = "recorded_audio.wav"
+        self.recorded_frames = []  # 16-bit PCM chunks of the current recording, kept in memory
         self.model = None  # To be loaded from models/base.pt
+        # Speech segments waiting for Whisper (None ends a recording) and the text of the current recording so far
+        self.speech_queue = queue.Queue()
+        self.speech_parts = []
+        self.stopped_at = None
 
         self.create_widgets()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         self.add_message("AI", "Hello! How can I help you today?")  # Welcome message
         # Load the Whisper model asynchronously
         threading.Thread(target=self.load_model, daemon=True).start()
+        threading.Thread(target=self.transcription_worker, daemon=True).start()
 
     def create_widgets(self):
         """Creates the chat UI."""
@@ -76,16 +416,8 @@ class ChatbotApp(tb.Window):
         self.chat_canvas.pack(fill=tk.BOTH, expand=True)
         self.scrollbar.config(command=self.chat_canvas.yview)
 
-        # Messages Frame
-        self.messages_frame = tk.Frame(self.chat_canvas, bg='#2d2d2d')
-        self.canvas_window = self.chat_canvas.create_window((0, 0), window=self.messages_frame, anchor='n')
-        self.messages_frame.bind("<Configure>", lambda event: self.chat_canvas.configure(scrollregion=self.chat_canvas.bbox("all")))
-        self.messages_frame.grid_columnconfigure(0, minsize=self.min_chat_width)
-
-        def update_scroll_region(event=None):
-            self.chat_canvas.configure(scrollregion=self.chat_canvas.bbox("all"))
-        self.messages_frame.bind("<Configure>", update_scroll_region)
-        self.chat_canvas.bind("<Configure>", update_scroll_region)
+        # Only the bubbles near the viewport exist as widgets
+        self.message_list = MessageList(self.chat_canvas, self.scrollbar, self.user_icon, self.ai_icon)
         self.bind_mouse_scroll()
 
         # Input area
@@ -103,6 +435,10 @@ class ChatbotApp(tb.Window):
         send_btn = tb.Button(input_frame, text="Send", command=self.send_message, bootstyle="primary")
         send_btn.pack(side=tk.RIGHT)
 
+        # Cancels the answer being generated (the backend stops when the connection closes)
+        self.stop_btn = tb.Button(input_frame, text="⏹ Stop", command=self.stop_response, bootstyle="danger", state=tk.DISABLED)
+        self.stop_btn.pack(side=tk.RIGHT, padx=(0, 5))
+
     def bind_mouse_scroll(self):
         """Ensures smooth scrolling across platforms."""
         self.chat_canvas.bind_all("<MouseWheel>", lambda e: self.chat_canvas.yview_scroll(int(-1*(e.delta/120)), "units"))
@@ -110,28 +446,19 @@ class ChatbotApp(tb.Window):
         self.chat_canvas.bind_all("<Button-5>", lambda e: self.chat_canvas.yview_scroll(1, "units"))
 
     def add_message(self, sender, message):
-        """Creates a chat bubble with Markdown rendering and updates conversation history."""
-        html_content = markdown.markdown(message, extensions=["fenced_code", "tables"])
-        styled_html = f"""
-        <div style="color: #ffffff; font-family: Arial, sans-serif; font-size: 14px; border-radius: 10px; padding: 10px;">
-            {html_content}
-        </div>
-        """
-        container = tk.Frame(self.messages_frame, bg='#2d2d2d')
-        container.grid(row=self.message_count, column=0, sticky='ne' if sender == "User" else 'nw', padx=5, pady=5)
-        msg_frame = tk.Frame(container, bg='#2d2d2d')
-        msg_frame.pack(side='right' if sender == "User" else 'left', anchor='ne' if sender == "User" else 'nw')
-        if sender == "User" and self.user_icon:
-            tk.Label(msg_frame, image=self.user_icon, bg='#2d2d2d').pack(side='right', padx=(5, 0))
-        bubble_frame = tk.Frame(msg_frame, bg="#0d6efd" if sender == "User" else "#6c757d")
-        bubble_frame.pack(side='right' if sender == "User" else 'left')
-        bubble_label = HTMLLabel(bubble_frame, html=styled_html, background="#0d6efd" if sender == "User" else "#6c757d", width=80)
-        bubble_label.pack(side='right' if sender == "User" else 'left', padx=10, pady=5)
-        bubble_label.fit_height()
-        if sender == "AI" and self.ai_icon:
-            tk.Label(msg_frame, image=self.ai_icon, bg='#2d2d2d').pack(side='left', padx=(0, 5))
-        self.message_count += 1
-        self.chat_canvas.yview_moveto(1.0)
+        """Adds a message to the chat view once its Markdown is rendered off the Tk thread (safe from any thread)."""
+        render_executor.submit(self.render_message, sender, message)
+
+    def render_message(self, sender, message):
+        started_at = time.perf_counter()
+        try:
+            html = render_markdown(message)
+        except Exception as e:
+            print(f"Markdown error: {e}")
+            html = message
+        render_ms = (time.perf_counter() - started_at) * 1000
+        # Only the widget work happens on the Tk thread
+        self.after(0, self.message_list.append, sender, message, html, render_ms)
 
     def load_model(self):
         """Loads the Whisper model from the local models/ folder asynchronously."""
@@ -148,59 +475,105 @@ class ChatbotApp(tb.Window):
             self.add_message("AI", f"Error loading model: {e}")
 
     def recognize_speech(self):
-        """Toggles voice recording and transcribes speech using Whisper."""
+        """Toggles voice recording; speech is transcribed into the input box as the user talks."""
         if not self.is_recording:
+            if self.model is None:
+                # Checked once here rather than failing on every segment
+                self.add_message("AI", "The Whisper model isn't loaded yet. Please try again in a moment.")
+                return
             self.add_message("AI", "Listening... Click again to stop.")
+            self.speech_parts = []
+            self.stopped_at = None
             self.is_recording = True
             self.recording_thread = threading.Thread(target=self.record_audio, daemon=True)
             self.recording_thread.start()
             self.speak_btn.config(text="🛑 Stop")
         else:
+            # record_audio queues the rest of the recording and finish_speech runs once it is transcribed
+            self.stopped_at = time.perf_counter()
             self.is_recording = False
-            self.recording_thread.join()
-            self.speak_btn.config(text="🎤 Speak")
-            if os.path.exists(self.audio_file):
-                text = self.transcribe_audio(self.audio_file)
-                if text.strip():
-                    self.add_message("User", text)
-                    self.user_input.delete(0, tk.END)
-                    self.user_input.insert(0, text)
-                    self.send_message()  # Automatically send the transcribed text
-                else:
-                    self.add_message("AI", "I couldn't understand. Please try again.")
-            else:
-                self.add_message("AI", "Error: Audio file not saved properly.")
+            self.speak_btn.config(text="⏳ Transcribing...", state=tk.DISABLED)
 
     def record_audio(self):
-        """Records audio at 16kHz, 16-bit Mono and saves it as a WAV file."""
-        RATE, CHUNK, FORMAT, CHANNELS = 16000, 4096, pyaudio.paInt16, 1
-        mic = pyaudio.PyAudio()
+        """Records 16kHz, 16-bit Mono audio, queueing each speech segment for transcription as it closes."""
+        CHUNK, FORMAT, CHANNELS = 1600, pyaudio.paInt16, 1  # 100 ms reads keep segmenting responsive
+        self.recorded_frames = []
+        segmenter = SpeechSegmenter() if LIVE_TRANSCRIPTION else None
+        mic = None
         try:
-            stream = mic.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
-            frames = []
+            # Inside the try, so a missing or busy microphone still ends the recording below
+            mic = pyaudio.PyAudio()
+            stream = mic.open(format=FORMAT, channels=CHANNELS, rate=SAMPLE_RATE, input=True, frames_per_buffer=CHUNK)
             while self.is_recording:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
+                chunk = stream.read(CHUNK, exception_on_overflow=False)
+                self.recorded_frames.append(chunk)
+                if segmenter is not None:
+                    for segment in segmenter.feed(frames_to_audio([chunk])):
+                        self.speech_queue.put(segment)
             stream.stop_stream()
             stream.close()
-            mic.terminate()
-            with wave.open(self.audio_file, "wb") as wf:
-                wf.setnchannels(CHANNELS)
-                wf.setsampwidth(mic.get_sample_size(FORMAT))
-                wf.setframerate(RATE)
-                wf.writeframes(b''.join(frames))
         except Exception as e:
             self.add_message("AI", f"Recording error: {e}")
+        finally:
+            if mic is not None:
+                mic.terminate()
+            # Only the segment open at Stop is left (or the whole recording without live transcription)
+            rest = segmenter.flush() if segmenter is not None else frames_to_audio(self.recorded_frames)
+            if rest is not None and rest.size:
+                self.speech_queue.put(rest)
+            self.speech_queue.put(None)
+
+    def transcription_worker(self):
+        """Transcribes queued speech segments in order, showing the text so far in the input box."""
+        while True:
+            segment = self.speech_queue.get()
+            if segment is None:
+                if LIVE_TRANSCRIPTION and not self.speech_parts and self.recorded_frames:
+                    # No segment held words (e.g. speech too quiet for the VAD), so try the whole recording
+                    text = self.transcribe_audio(frames_to_audio(self.recorded_frames))
+                    if text:
+                        self.speech_parts.append(text)
+                self.after(0, self.finish_speech, " ".join(self.speech_parts))
+                continue
+            started_at = time.perf_counter()
+            # The text so far as the prompt keeps wording and punctuation consistent across segments
+            text = self.transcribe_audio(segment, " ".join(self.speech_parts))
+            print(f"Transcribed {len(segment) / SAMPLE_RATE:.1f} s segment in {(time.perf_counter() - started_at) * 1000:.0f} ms")
+            if text:
+                self.speech_parts.append(text)
+                self.after(0, self.show_partial_speech, " ".join(self.speech_parts))
+
+    def show_partial_speech(self, text):
+        self.user_input.delete(0, tk.END)
+        self.user_input.insert(0, text)
+
+    def finish_speech(self, text):
+        """Sends the finished transcription; runs on the Tk thread."""
+        # The recording may also have ended on its own, when the microphone failed
+        self.is_recording = False
+        if self.stopped_at is not None:
+            seconds = sum(len(frame) for frame in self.recorded_frames) / 2 / SAMPLE_RATE
+            print(f"Stop-to-text: {(time.perf_counter() - self.stopped_at) * 1000:.0f} ms for {seconds:.1f} s of audio")
+        self.speak_btn.config(text="🎤 Speak", state=tk.NORMAL)
+        if not self.recorded_frames:
+            self.add_message("AI", "Error: Nothing was recorded.")
+        elif text.strip():
+            self.show_partial_speech(text)
+            self.send_message()  # Automatically send the transcribed text
+        else:
+            self.add_message("AI", "I couldn't understand. Please try again.")
 
-    def transcribe_audio(self, file_path):
-        """Transcribes speech from an audio file using Whisper."""
+    def transcribe_audio(self, audio, prompt=""):
+        """Transcribes a 16kHz float32 audio array using Whisper ("" if it can't)."""
         if self.model is None:
-            return "Error: Whisper model not loaded."
+            self.add_message("AI", "Error: Whisper model not loaded.")
+            return ""
         try:
-            result = self.model.transcribe(file_path)
+            result = self.model.transcribe(audio, fp16=self.model.device.type == "cuda", initial_prompt=prompt or None)
             return result["text"].strip()
         except Exception as e:
-            return f"Transcription error: {e}"
+            self.add_message("AI", f"Transcription error: {e}")
+            return ""
 
     def send_message(self):
         """Sends user message along with conversation history to the backend and updates history."""
@@ -211,20 +584,61 @@ class ChatbotApp(tb.Window):
         self.conversation_history.append(f"[USER]: {user_text}")
         self.user_input.delete(0, tk.END)
         self.user_input.config(state=tk.DISABLED)
-        threading.Thread(target=self.get_ai_response, args=(user_text,), daemon=True).start()
+        self.stop_btn.config(state=tk.NORMAL)
+        self.pending_response = self.network.submit(self.get_ai_response(user_text), self.on_ai_response)
 
-    def get_ai_response(self, user_text):
-        """Sends conversation history and the latest message to the backend and appends the assistant response to history."""
-        try:
-            payload = {"history": self.conversation_history, "message": user_text}
-            response = requests.post(API_URL, json=payload)
-            ai_text = response.json().get("response", "Error: No response")
-            self.after(0, self.add_message, "AI", ai_text)
+    def stop_response(self):
+        """Cancels the request in flight."""
+        if self.pending_response is not None:
+            self.pending_response.cancel()
+
+    async def create_session(self, history):
+        """Starts a backend chat session seeded with the given history and returns its id."""
+        response = await self.network.post_json(SESSIONS_URL, {"history": history})
+        response.raise_for_status()
+        return response.json()["session_id"]
+
+    async def get_ai_response(self, user_text):
+        """Sends the latest message to the backend session and returns the assistant response."""
+        # Only the new message is sent; the backend keeps the rest of the conversation
+        if self.session_id is None:
+            self.session_id = await self.create_session(self.conversation_history[:-1])
+        response = await self.network.post_json(f"{SESSIONS_URL}/{self.session_id}/messages", {"message": user_text})
+        if response.status_code == 404:
+            # The backend lost the session (e.g. it restarted), so seed a new one with our history
+            self.session_id = await self.create_session(self.conversation_history[:-1])
+            response = await self.network.post_json(f"{SESSIONS_URL}/{self.session_id}/messages", {"message": user_text})
+        response.raise_for_status()
+        return response.json().get("response", "Error: No response")
+
+    def on_ai_response(self, ai_text, error):
+        """Shows the answer (or why there is none) and unlocks the input; runs on the Tk thread."""
+        self.pending_response = None
+        self.stop_btn.config(state=tk.DISABLED)
+        self.user_input.config(state=tk.NORMAL)
+        if error is None:
+            self.add_message("AI", ai_text)
             self.conversation_history.append(f"[ASSISTANT]: {ai_text}")
-        except Exception as e:
-            self.after(0, lambda: messagebox.showerror("Error", f"Failed to connect: {str(e)}"))
-        finally:
-            self.after(0, lambda: self.user_input.config(state=tk.NORMAL))
+            return
+        # The backend leaves the session unchanged when a turn doesn't finish, so forget it here too
+        self.conversation_history.pop()
+        if isinstance(error, asyncio.CancelledError):
+            self.add_message("AI", "Stopped.")
+        elif isinstance(error, httpx.TimeoutException):
+            messagebox.showerror("Error", f"The backend did not answer within {REQUEST_TIMEOUT:.0f} seconds.")
+        else:
+            messagebox.showerror("Error", f"Failed to connect: {str(error)}")
+
+    def on_close(self):
+        """Deletes the backend session, so its llama state doesn't outlive the window, and closes it."""
+        self.stop_response()
+        if self.session_id is not None:
+            delete = self.network.client.delete(f"{SESSIONS_URL}/{self.session_id}")
+            try:
+                asyncio.run_coroutine_threadsafe(delete, self.network.loop).result(timeout=CONNECT_TIMEOUT)
+            except Exception as e:
+                print(f"Could not delete session {self.session_id}: {e}")
+        self.destroy()
 
     def clear_text(self):
         """Clears the text display."""
@@ -234,21 +648,23 @@ if __name__ == "__main__":
     import subprocess, time, requests
     backend_process = subprocess.Popen(["python", "backend.py"])
     print("Waiting for backend to start...")
-    time.sleep(5)
+    # /readyz answers 200 once the model is loaded and warmed up; poll it instead of guessing
     backend_ready = False
-    for _ in range(10):
+    deadline = time.time() + 300
+    while time.time() < deadline and backend_process.poll() is None:
         try:
-            r = requests.get("http://127.0.0.1:8000/chat")
-            if r.status_code == 405:
+            r = requests.get("http://127.0.0.1:8000/readyz", timeout=2)
+            if r.status_code == 200:
                 backend_ready = True
                 print("Backend is ready!")
                 break
         except requests.ConnectionError:
-            print("Backend not ready yet, retrying...")
-            time.sleep(2)
+            pass
+        time.sleep(0.5)
     if not backend_ready:
         print("Error: Backend failed to start. Check logs.")
         exit(1)
     app = ChatbotApp()
     app.mainloop()
+    app.network.close()
     backend_process.terminate()
@@ -0,0 +1,64 @@
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import wave
+import whisper
+from test2 import SAMPLE_RATE, frames_to_audio
+
+# Stop-to-text latency of the two ways of handing a recording to Whisper, on a saved recording:
+#   wav:    write the frames to a WAV file and pass its path (Whisper runs ffmpeg to decode it again)
+#   memory: convert the int16 frames to float32 in memory and pass the array
+#
+# The apps no longer save their recordings, so capture one as a 16kHz 16-bit mono WAV first:
+#   arecord -f S16_LE -r 16000 -c 1 -d 10 my_recording.wav     (Linux, 10 s from the default mic)
+#   ffmpeg -i speech.m4a -ar 16000 -ac 1 -sample_fmt s16 my_recording.wav     (any existing file)
+#
+#   python bench_stop_to_text.py my_recording.wav
+#   python bench_stop_to_text.py my_recording.wav --model small --repeats 5
+
+def read_frames(path):
+    """The PCM frames of a 16kHz, 16-bit mono WAV, as record_audio would have collected them."""
+    with wave.open(path, "rb") as wf:
+        if (wf.getframerate(), wf.getsampwidth(), wf.getnchannels()) != (SAMPLE_RATE, 2, 1):
+            raise SystemExit(f"{path} is not 16kHz 16-bit mono")
+        return [wf.readframes(wf.getnframes())]
+
+def via_wav(model, frames, fp16):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "recording.wav")
+        with wave.open(path, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(SAMPLE_RATE)
+            wf.writeframes(b"".join(frames))
+        return model.transcribe(path, fp16=fp16)["text"].strip()
+
+def in_memory(model, frames, fp16):
+    return model.transcribe(frames_to_audio(frames), fp16=fp16)["text"].strip()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare WAV round trip vs in-memory audio for Whisper.")
+    parser.add_argument("recording", help="16kHz 16-bit mono WAV to transcribe")
+    parser.add_argument("--model", default=os.path.join("models", "base.pt"))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = whisper.load_model(args.model)
+    fp16 = model.device.type == "cuda"
+    frames = read_frames(args.recording)
+    seconds = len(frames[0]) / 2 / SAMPLE_RATE
+    in_memory(model, frames, fp16)  # warm up
+
+    print(f"{seconds:.1f} s of audio, {args.repeats} runs each")
+    for name, fn in [("wav", via_wav), ("memory", in_memory)]:
+        latencies = []
+        for _ in range(args.repeats):
+            started_at = time.perf_counter()
+            text = fn(model, frames, fp16)
+            latencies.append((time.perf_counter() - started_at) * 1000)
+        print(f"{name:<8} median {statistics.median(latencies):7.0f} ms  min {min(latencies):7.0f} ms  {text[:60]!r}")
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,20 @@ import tkinter as tk
 import torch
 import whisper
 import pyaudio
-import wave
+import numpy as np
 import threading
 import os
+import time
 from tkinter import filedialog
 from pydub import AudioSegment
 
+# Whisper works on 16 kHz mono audio
+SAMPLE_RATE = 16000
+
+def frames_to_audio(frames):
+    """Recorded 16-bit PCM frames as the float32 array in [-1, 1) Whisper takes (no WAV file, no ffmpeg)."""
+    return np.frombuffer(b"".join(frames), dtype=np.int16).astype(np.float32) / 32768.0
+
 class SpeechRecognitionApp:
     def __init__(self, root):
         self.root = root
@@ -15,8 +23,7 @@ class SpeechRecognitionApp:
         self.root.geometry("500x300")
 
         self.is_recording = False
-        self.audio_file = "recorded_audio.wav"
-        self.converted_audio = "converted_audio.wav"  # Converted file for non-WAV formats
+        self.recorded_frames = []  # 16-bit PCM chunks of the current recording, kept in memory
         self.model = None
 
         # UI Elements
@@ -59,42 +66,38 @@ class SpeechRecognitionApp:
             self.recording_thread = threading.Thread(target=self.record_audio, daemon=True)
             self.recording_thread.start()
         else:
+            stopped_at = time.perf_counter()
             self.is_recording = False
             self.recording_thread.join()
             self.record_btn.config(text="🎤 Start Recording", bg="lightblue")
 
-            if os.path.exists(self.audio_file):
-                text = self.transcribe_audio(self.audio_file)
+            if self.recorded_frames:
+                audio = frames_to_audio(self.recorded_frames)
+                text = self.transcribe_audio(audio)
+                print(f"Stop-to-text: {(time.perf_counter() - stopped_at) * 1000:.0f} ms for {len(audio) / SAMPLE_RATE:.1f} s of audio")
                 self.text_display.insert(tk.END, text + "\n" if text else "I couldn't understand. Try again.\n")
             else:
-                self.text_display.insert(tk.END, "Error: Audio file not saved properly.\n")
+                self.text_display.insert(tk.END, "Error: Nothing was recorded.\n")
 
     def record_audio(self):
-        """Records directly at 16kHz, 16-bit Mono and saves it as a WAV file."""
-        RATE, CHUNK, FORMAT, CHANNELS = 16000, 4096, pyaudio.paInt16, 1
+        """Records directly at 16kHz, 16-bit Mono into recorded_frames (nothing is written to disk)."""
+        CHUNK, FORMAT, CHANNELS = 4096, pyaudio.paInt16, 1
+        self.recorded_frames = []
         mic = pyaudio.PyAudio()
 
         try:
-            stream = mic.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
-            frames = []
+            stream = mic.open(format=FORMAT, channels=CHANNELS, rate=SAMPLE_RATE, input=True, frames_per_buffer=CHUNK)
 
             while self.is_recording:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
+                self.recorded_frames.append(stream.read(CHUNK, exception_on_overflow=False))
 
             stream.stop_stream()
             stream.close()
-            mic.terminate()
-
-            # Save as WAV file
-            with wave.open(self.audio_file, "wb") as wf:
-                wf.setnchannels(CHANNELS)
-                wf.setsampwidth(mic.get_sample_size(FORMAT))
-                wf.setframerate(RATE)
-                wf.writeframes(b''.join(frames))
 
         except Exception as e:
             self.text_display.insert(tk.END, f"Recording error: {e}\n")
+        finally:
+            mic.terminate()
 
     def upload_audio(self):
         """Allows the user to select an audio file and converts if needed."""
@@ -104,36 +107,32 @@ class SpeechRecognitionApp:
 
         self.text_display.insert(tk.END, f"Processing file: {file_path}\n")
 
-        # Convert to WAV if needed
-        if file_path.endswith(".wav"):
-            self.text_display.insert(tk.END, "Using WAV file as is.\n")
-            final_audio = file_path
-        else:
-            self.text_display.insert(tk.END, "Converting audio to WAV...\n")
-            final_audio = self.convert_audio(file_path)
+        # Decode, downmix and resample in memory
+        audio = self.convert_audio(file_path)
+        if audio is None:
+            return
 
-        # Transcribe the final audio file
-        text = self.transcribe_audio(final_audio)
+        # Transcribe the decoded audio
+        text = self.transcribe_audio(audio)
         self.text_display.insert(tk.END, text + "\n" if text else "I couldn't understand. Try again.\n")
 
     def convert_audio(self, input_path):
-        """Converts MP3 or M4A files to WAV format."""
+        """Decodes an MP3, M4A or WAV file to 16kHz mono float32 samples, without a temporary WAV."""
         try:
             audio = AudioSegment.from_file(input_path)
-            audio = audio.set_channels(1).set_frame_rate(16000).set_sample_width(2)  # Convert to Mono, 16kHz, 16-bit
-            audio.export(self.converted_audio, format="wav")
-            return self.converted_audio
+            audio = audio.set_channels(1).set_frame_rate(SAMPLE_RATE).set_sample_width(2)  # Convert to Mono, 16kHz, 16-bit
+            return frames_to_audio([audio.raw_data])
         except Exception as e:
             self.text_display.insert(tk.END, f"Conversion error: {e}\n")
             return None
 
-    def transcribe_audio(self, file_path):
-        """Transcribes speech from an audio file using Whisper."""
+    def transcribe_audio(self, audio):
+        """Transcribes a 16kHz float32 audio array using Whisper."""
         if self.model is None:
             return "Error: Whisper model not loaded."
 
         try:
-            result = self.model.transcribe(file_path)
+            result = self.model.transcribe(audio, fp16=self.model.device.type == "cuda")
             return result["text"].strip()
         except Exception as e:
             return f"Transcription error: {e}"
@@ -1,9 +1,16 @@
 import tkinter as tk
 import whisper
 import pyaudio
-import wave
+import numpy as np
 import threading
-import os
+import time
+
+# Whisper works on 16 kHz mono audio
+SAMPLE_RATE = 16000
+
+def frames_to_audio(frames):
+    """Recorded 16-bit PCM frames as the float32 array in [-1, 1) Whisper takes (no WAV file, no ffmpeg)."""
+    return np.frombuffer(b"".join(frames), dtype=np.int16).astype(np.float32) / 32768.0
 
 class SpeechRecognitionApp:
     def __init__(self, root):
@@ -12,7 +19,7 @@ class SpeechRecognitionApp:
         self.root.geometry("500x300")
 
         self.is_recording = False
-        self.audio_file = "recorded_audio.wav"
+        self.recorded_frames = []  # 16-bit PCM chunks of the current recording, kept in memory
         self.model = None
 
         # UI Elements
@@ -47,50 +54,46 @@ class SpeechRecognitionApp:
             self.recording_thread = threading.Thread(target=self.record_audio, daemon=True)
             self.recording_thread.start()
         else:
+            stopped_at = time.perf_counter()
             self.is_recording = False
             self.recording_thread.join()
             self.record_btn.config(text="🎤 Start Recording", bg="lightblue")
 
-            if os.path.exists(self.audio_file):
-                text = self.transcribe_audio(self.audio_file)
+            if self.recorded_frames:
+                audio = frames_to_audio(self.recorded_frames)
+                text = self.transcribe_audio(audio)
+                print(f"Stop-to-text: {(time.perf_counter() - stopped_at) * 1000:.0f} ms for {len(audio) / SAMPLE_RATE:.1f} s of audio")
                 self.text_display.insert(tk.END, text + "\n" if text else "I couldn't understand. Try again.\n")
             else:
-                self.text_display.insert(tk.END, "Error: Audio file not saved properly.\n")
+                self.text_display.insert(tk.END, "Error: Nothing was recorded.\n")
 
     def record_audio(self):
-        """Records directly at 16kHz, 16-bit Mono and saves it as a WAV file."""
-        RATE, CHUNK, FORMAT, CHANNELS = 16000, 4096, pyaudio.paInt16, 1
+        """Records directly at 16kHz, 16-bit Mono into recorded_frames (nothing is written to disk)."""
+        CHUNK, FORMAT, CHANNELS = 4096, pyaudio.paInt16, 1
+        self.recorded_frames = []
         mic = pyaudio.PyAudio()
 
         try:
-            stream = mic.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
-            frames = []
+            stream = mic.open(format=FORMAT, channels=CHANNELS, rate=SAMPLE_RATE, input=True, frames_per_buffer=CHUNK)
 
             while self.is_recording:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
+                self.recorded_frames.append(stream.read(CHUNK, exception_on_overflow=False))
 
             stream.stop_stream()
             stream.close()
-            mic.terminate()
-
-            # Save as WAV file
-            with wave.open(self.audio_file, "wb") as wf:
-                wf.setnchannels(CHANNELS)
-                wf.setsampwidth(mic.get_sample_size(FORMAT))
-                wf.setframerate(RATE)
-                wf.writeframes(b''.join(frames))
 
         except Exception as e:
             self.text_display.insert(tk.END, f"Recording error: {e}\n")
+        finally:
+            mic.terminate()
 
-    def transcribe_audio(self, file_path):
-        """Transcribes speech from an audio file using Whisper."""
+    def transcribe_audio(self, audio):
+        """Transcribes a 16kHz float32 audio array using Whisper."""
         if self.model is None:
             return "Error: Whisper model not loaded."
 
         try:
-            result = self.model.transcribe(file_path)
+            result = self.model.transcribe(audio, fp16=self.model.device.type == "cuda")
             return result["text"].strip()
         except Exception as e:
             return f"Transcription error: {e}"
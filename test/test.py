@@ -1,5 +1,191 @@
-import requests
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import httpx
 
-API_URL = "http://127.0.0.1:8000/chat"
-response = requests.post(API_URL, json={"message": "Hello!"})
-print(response.json())
+# Load generator for the chat backends (needs httpx: pip install httpx).
+#
+# Open loop (requests arrive at --rate per second, Poisson, whether or not earlier ones finished):
+#   python test.py --rate 2 --duration 60 --trace trace.jsonl --output run.json
+# Closed loop (--concurrency clients, each sends its next request when the last one finishes):
+#   python test.py --concurrency 4 --requests 100 --stream
+#
+# Each trace line is a request body for /chat ({"message": ..., "history": [...], "model": ...})
+# with an optional "weight" for how often it is picked. Without --trace every request is "Hello!".
+
+API_URL = "http://127.0.0.1:8000"
+
+def load_trace(path):
+    """Reads the request mix from a JSONL file, one request body per line."""
+    if path is None:
+        return [{"message": "Hello!"}], [1]
+    bodies, weights = [], []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                body = json.loads(line)
+                weights.append(body.pop("weight", 1))
+                bodies.append(body)
+    return bodies, weights
+
+async def send_chat(client, url, body):
+    """One blocking /chat request; returns its result record."""
+    started_at = time.perf_counter()
+    response = await client.post(f"{url}/chat", json=body)
+    record = {"status": response.status_code, "latency_s": time.perf_counter() - started_at}
+    if response.status_code == 200:
+        record["completion_tokens"] = response.json().get("usage", {}).get("completion_tokens")
+    else:
+        record["error"] = response.text[:200]
+    return record
+
+async def send_stream(client, url, body):
+    """One /chat/stream request, timing the first token event; returns its result record."""
+    started_at = time.perf_counter()
+    record = {"status": None, "completion_tokens": None}
+    async with client.stream("POST", f"{url}/chat/stream", json=body) as response:
+        record["status"] = response.status_code
+        if response.status_code != 200:
+            record["error"] = (await response.aread()).decode("utf-8", "replace")[:200]
+        else:
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "token" and "ttft_s" not in record:
+                        record["ttft_s"] = time.perf_counter() - started_at
+                    elif event == "done":
+                        record["completion_tokens"] = data.get("usage", {}).get("completion_tokens")
+                    elif event == "error":
+                        record["error"] = data.get("detail")
+    record["latency_s"] = time.perf_counter() - started_at
+    return record
+
+async def run_request(client, args, body, results):
+    send = send_stream if args.stream else send_chat
+    try:
+        record = await send(client, args.url, body)
+    except httpx.HTTPError as e:
+        record = {"status": None, "error": f"{type(e).__name__}: {e}"}
+    record["history_turns"] = len(body.get("history", []))
+    results.append(record)
+
+async def open_loop(client, args, bodies, weights, results):
+    """Starts requests at Poisson arrival times at --rate per second."""
+    rng = random.Random(args.seed)
+    tasks = []
+    started_at = time.perf_counter()
+    next_at = started_at
+    while len(tasks) < args.requests and next_at - started_at < args.duration:
+        await asyncio.sleep(max(0, next_at - time.perf_counter()))
+        body = rng.choices(bodies, weights)[0]
+        tasks.append(asyncio.create_task(run_request(client, args, body, results)))
+        next_at += rng.expovariate(args.rate)
+    await asyncio.gather(*tasks)
+
+async def closed_loop(client, args, bodies, weights, results):
+    """Runs --concurrency clients that each send their next request as soon as the last one is done."""
+    rng = random.Random(args.seed)
+    started_at = time.perf_counter()
+    sent = 0
+
+    async def client_loop():
+        nonlocal sent
+        while sent < args.requests and time.perf_counter() - started_at < args.duration:
+            sent += 1
+            await run_request(client, args, rng.choices(bodies, weights)[0], results)
+
+    await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+
+def percentiles(values):
+    """p50/p90/p99 (nearest rank), mean and max of a list of seconds, in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+    return {
+        "p50_ms": round(pick(50) * 1000, 1),
+        "p90_ms": round(pick(90) * 1000, 1),
+        "p99_ms": round(pick(99) * 1000, 1),
+        "mean_ms": round(sum(values) / len(values) * 1000, 1),
+        "max_ms": round(values[-1] * 1000, 1),
+    }
+
+def summarize(results, wall_s):
+    ok = [r for r in results if r["status"] == 200 and "error" not in r]
+    tokens = sum(r.get("completion_tokens") or 0 for r in ok)
+    statuses = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else None,
+        "statuses": statuses,
+        "wall_s": round(wall_s, 2),
+        "achieved_rps": round(len(ok) / wall_s, 3) if wall_s > 0 else None,
+        "completion_tokens": tokens,
+        "tokens_per_second": round(tokens / wall_s, 2) if wall_s > 0 else None,
+        "latency": percentiles([r["latency_s"] for r in ok]),
+        "time_to_first_token": percentiles([r["ttft_s"] for r in ok if "ttft_s" in r]),
+        "errors": sorted({r["error"] for r in results if r.get("error")})[:10],
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+async def main():
+    parser = argparse.ArgumentParser(description="Open- or closed-loop load generator for /chat.")
+    parser.add_argument("--url", default=API_URL)
+    parser.add_argument("--trace", help="JSONL file of request bodies (with optional \"weight\")")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--rate", type=float, help="open loop: mean arrivals per second")
+    mode.add_argument("--concurrency", type=int, default=1, help="closed loop: number of clients")
+    parser.add_argument("--requests", type=int, help="stop after this many requests (default 20 without --duration)")
+    parser.add_argument("--duration", type=float, default=float("inf"), help="stop sending after this many seconds")
+    parser.add_argument("--stream", action="store_true", help="use /chat/stream and measure time to first token")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the run (settings, summary and every request) as JSON")
+    args = parser.parse_args()
+    if args.requests is None:
+        args.requests = 20 if args.duration == float("inf") else sys.maxsize
+
+    bodies, weights = load_trace(args.trace)
+    results = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        started_at = time.perf_counter()
+        if args.rate:
+            await open_loop(client, args, bodies, weights, results)
+        else:
+            await closed_loop(client, args, bodies, weights, results)
+        wall_s = time.perf_counter() - started_at
+
+    summary = summarize(results, wall_s)
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        run = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "settings": {**vars(args), "duration": None if args.duration == float("inf") else args.duration},
+            "summary": summary,
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main())
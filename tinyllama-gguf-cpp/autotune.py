@@ -0,0 +1,141 @@
+from llama_cpp import Llama
+import argparse
+import json
+import os
+import platform
+import time
+
+# Sweeps llama.cpp threading and batch sizes on this machine and saves the fastest settings
+# next to the model as <model>.gguf.tuning.json, which the backends and test.py load at startup.
+#
+#   python autotune.py
+#   python autotune.py ../llm-app/models/tinyllama-1.1b-chat-v1.0.Q2_K.gguf --threads 2 4 6 8
+#
+# Decode (one token per forward pass) and prefill (whole prompts per forward pass) are tuned
+# separately: decode picks n_threads, prefill picks n_threads_batch, n_batch and n_ubatch.
+# Decode is usually memory bound, so it often peaks below the number of logical cores.
+
+MODEL_PATH = "./tinyllama-1.1b-chat-v1.0.Q2_K.gguf"
+
+# Settings from the tuning file that are passed straight to Llama(...)
+TUNING_PARAMS = ("n_threads", "n_threads_batch", "n_batch", "n_ubatch")
+
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant. Answer questions concisely and professionally. "
+    "Provide responses short and simple. Avoid technical jargon and complex sentences."
+)
+
+PROMPTS = [
+    "Who is Elon Musk?",
+    "Explain the difference between a process and a thread, and when you would use each.",
+    "Here is a conversation so far. [USER]: I want to learn Python. [ASSISTANT]: Great choice! "
+    "Start with variables, loops and functions. [USER]: What should I build first? "
+    "[ASSISTANT]: A small command line tool, like a to-do list. [USER]: And after that?",
+]
+
+def load_tuning(model_path):
+    """Threading and batch sizes saved by autotune.py for a model on this host, or {} for llama.cpp's defaults."""
+    path = model_path + ".tuning.json"
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        tuning = json.load(f)
+    if tuning.get("cpu_count") != os.cpu_count():
+        print(f"Ignoring {path}: tuned on {tuning.get('cpu_count')} CPUs, this host has {os.cpu_count()}")
+        return {}
+    return {name: tuning[name] for name in TUNING_PARAMS if name in tuning}
+
+def default_thread_counts():
+    """Powers of two up to the logical core count, plus half of them (the physical cores with SMT)."""
+    logical = os.cpu_count() or 1
+    counts = {logical, max(1, logical // 2)}
+    n = 1
+    while n < logical:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+def measure(model_path, n_ctx, params, decode_tokens, repeats):
+    """Prefill and decode tokens/sec for one set of Llama params, best of repeats."""
+    llm = Llama(model_path=model_path, n_ctx=n_ctx, use_mmap=True, verbose=False, **params)
+    prompts = [llm.tokenize(f"[SYSTEM]: {SYSTEM_PROMPT}\n[USER]: {p}\n[ASSISTANT]:".encode("utf-8")) for p in PROMPTS]
+    llm.eval(prompts[0])  # warm up: fault in the weights
+    prefill, decode = 0.0, 0.0
+    for _ in range(repeats):
+        tokens, seconds = 0, 0.0
+        for prompt in prompts:
+            llm.reset()
+            started_at = time.perf_counter()
+            llm.eval(prompt)
+            seconds += time.perf_counter() - started_at
+            tokens += len(prompt)
+        prefill = max(prefill, tokens / seconds)
+        # Decode cost doesn't depend on which token is fed back, so replaying prompt tokens one
+        # at a time times the forward passes without sampling noise
+        started_at = time.perf_counter()
+        for i in range(decode_tokens):
+            llm.eval([prompts[-1][i % len(prompts[-1])]])
+        decode = max(decode, decode_tokens / (time.perf_counter() - started_at))
+    llm.close()
+    return round(prefill, 2), round(decode, 2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune n_threads / n_batch / n_ubatch for a GGUF model on this CPU.")
+    parser.add_argument("model", nargs="?", default=MODEL_PATH)
+    parser.add_argument("--threads", type=int, nargs="+", default=default_thread_counts())
+    parser.add_argument("--batch", type=int, nargs="+", default=[128, 256, 512, 1024])
+    parser.add_argument("--ubatch", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--n-ctx", type=int, default=2048)
+    parser.add_argument("--decode-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--dry-run", action="store_true", help="print the results without saving them")
+    args = parser.parse_args()
+
+    results = []
+
+    # Decode only depends on the thread count
+    print("Decode sweep")
+    for n_threads in args.threads:
+        _, decode = measure(args.model, args.n_ctx, {"n_threads": n_threads}, args.decode_tokens, args.repeats)
+        results.append({"phase": "decode", "n_threads": n_threads, "decode_tokens_per_second": decode})
+        print(f"  n_threads={n_threads:<4} decode {decode:8.2f} tok/s")
+    best_decode = max((r for r in results if r["phase"] == "decode"), key=lambda r: r["decode_tokens_per_second"])
+
+    print("Prefill sweep")
+    best_prefill = None
+    for n_threads_batch in args.threads:
+        for n_batch in args.batch:
+            for n_ubatch in [u for u in args.ubatch if u <= n_batch]:
+                params = {
+                    "n_threads": best_decode["n_threads"], "n_threads_batch": n_threads_batch,
+                    "n_batch": n_batch, "n_ubatch": n_ubatch,
+                }
+                prefill, _ = measure(args.model, args.n_ctx, params, 1, args.repeats)
+                result = {"phase": "prefill", **params, "prefill_tokens_per_second": prefill}
+                results.append(result)
+                print(f"  n_threads_batch={n_threads_batch:<4} n_batch={n_batch:<5} n_ubatch={n_ubatch:<5} prefill {prefill:8.2f} tok/s")
+                if best_prefill is None or prefill > best_prefill["prefill_tokens_per_second"]:
+                    best_prefill = result
+
+    tuning = {
+        "n_threads": best_decode["n_threads"],
+        "n_threads_batch": best_prefill["n_threads_batch"],
+        "n_batch": best_prefill["n_batch"],
+        "n_ubatch": best_prefill["n_ubatch"],
+        "decode_tokens_per_second": best_decode["decode_tokens_per_second"],
+        "prefill_tokens_per_second": best_prefill["prefill_tokens_per_second"],
+        "cpu_count": os.cpu_count(),
+        "host": platform.node(),
+        "processor": platform.processor(),
+        "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    print(json.dumps({name: tuning[name] for name in TUNING_PARAMS}))
+    if not args.dry_run:
+        path = args.model + ".tuning.json"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(tuning, f, indent=2)
+        print(f"Saved to {path}")
+
+if __name__ == "__main__":
+    main()
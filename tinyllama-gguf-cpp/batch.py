@@ -0,0 +1,110 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from test import MODEL_PATH, SYSTEM_PROMPT, GENERATION_PARAMS, load_model, generate
+
+# Offline batch completions: reads prompts from JSONL, runs them on a pool of model processes
+# and appends one JSONL result per prompt as soon as it finishes (so in completion order).
+#
+#   python batch.py prompts.jsonl results.jsonl --workers 4
+#
+# Input lines: {"id": "q1", "prompt": "Who is Elon Musk?"} plus optional "system" and any
+# generation setting from test.GENERATION_PARAMS (e.g. "max_tokens"). Lines without an id are
+# numbered by their line number. Any other field (metadata) is copied into the result line.
+#
+# The output file is the checkpoint: every result is flushed to disk as it is written, and a
+# rerun with the same output file skips the ids already in it, so a killed run picks up where
+# it stopped. Failed prompts are written with an "error" and retried with --retry-errors (the
+# later line for an id wins).
+
+worker_llm = None
+
+def init_worker(model_path, n_threads):
+    """Loads the model once per worker process; the mmap'd weights are shared between them."""
+    global worker_llm
+    worker_llm = load_model(model_path, n_threads=n_threads)
+
+def run_prompt(item):
+    """Completes one input item inside a worker and returns its result line."""
+    started_at = time.perf_counter()
+    overrides = {name: value for name, value in item.items() if name in GENERATION_PARAMS}
+    # Metadata goes into the result as is ("error" is left out: it marks a line for --retry-errors)
+    extra = {name: value for name, value in item.items() if name not in GENERATION_PARAMS and name not in ("prompt", "system", "error")}
+    try:
+        response = generate(worker_llm, item["prompt"], item.get("system", SYSTEM_PROMPT), **overrides)
+    except Exception as e:
+        return {**extra, "id": item["id"], "error": str(e)}
+    return {
+        **extra,
+        "id": item["id"],
+        "text": response["choices"][0]["text"].strip(),
+        "finish_reason": response["choices"][0]["finish_reason"],
+        "prompt_tokens": response["usage"]["prompt_tokens"],
+        "completion_tokens": response["usage"]["completion_tokens"],
+        "seconds": round(time.perf_counter() - started_at, 3),
+        "worker": os.getpid(),
+    }
+
+def read_inputs(path):
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                item = json.loads(line)
+                item.setdefault("id", number)
+                yield item
+
+def read_checkpoint(path, retry_errors):
+    """Ids already in the output file, after cutting off a last line left half-written by a kill."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        complete = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break
+            complete += len(line)
+            if not (retry_errors and "error" in result):
+                done.add(result["id"])
+        f.truncate(complete)
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description="Run JSONL prompts through TinyLlama on a pool of workers.")
+    parser.add_argument("input", help="JSONL prompts")
+    parser.add_argument("output", help="JSONL results, appended to and used to resume")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 4))
+    parser.add_argument("--retry-errors", action="store_true", help="run prompts whose earlier result was an error again")
+    args = parser.parse_args()
+
+    done = read_checkpoint(args.output, args.retry_errors)
+    todo = [item for item in read_inputs(args.input) if item["id"] not in done]
+    print(f"{len(done)} already done, {len(todo)} to run on {args.workers} workers")
+    if not todo:
+        return
+
+    # Split the cores between the workers instead of letting each one use all of them
+    n_threads = max(1, (os.cpu_count() or 1) // args.workers)
+    started_at = time.perf_counter()
+    completed = failed = 0
+    with open(args.output, "a", encoding="utf-8") as out, \
+            multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.model, n_threads)) as pool:
+        for result in pool.imap_unordered(run_prompt, todo):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+            completed += 1
+            failed += "error" in result
+            if completed % 10 == 0 or completed == len(todo):
+                rate = completed / (time.perf_counter() - started_at)
+                print(f"{completed}/{len(todo)} done ({failed} failed), {rate:.2f} prompts/s")
+
+if __name__ == "__main__":
+    main()
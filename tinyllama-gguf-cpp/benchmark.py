@@ -0,0 +1,223 @@
+import argparse
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Compares the llama_cpp and ctransformers backends across every GGUF quantization in this
+# folder (Q2_K, Q4_K_M, Q8_0, ...), CPU only, on the same prompts with greedy decoding.
+#
+#   python benchmark.py
+#   python benchmark.py --models-dir ../llm-app/models --max-new-tokens 64 --output results.json
+#
+# Every backend/model pair runs in its own process, so load time and peak RSS are not skewed
+# by whatever an earlier run left in memory.
+
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant. Answer questions concisely and professionally. "
+    "Provide responses short and simple. Avoid technical jargon and complex sentences."
+)
+
+PROMPTS = [
+    "Who is Elon Musk?",
+    "Hello! How are you?",
+    "Explain what a GGUF file is in two sentences.",
+    "Write a haiku about the ocean.",
+]
+
+STOP = ["[USER]:", "\n[ASSISTANT]:"]
+
+BACKENDS = ["llama_cpp", "ctransformers"]
+
+class LlamaCppRunner:
+    def __init__(self, model_path, n_ctx):
+        from llama_cpp import Llama
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=0, use_mmap=True, verbose=False)
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text.encode("utf-8"))
+
+    def reset(self):
+        self.llm.reset()
+
+    def eval(self, tokens):
+        self.llm.eval(tokens)
+
+    def greedy(self):
+        return self.llm.sample(top_k=1, temp=0.0)
+
+    def is_eos(self, token):
+        return token == self.llm.token_eos()
+
+    def detokenize(self, tokens):
+        return self.llm.detokenize(tokens).decode("utf-8", "ignore")
+
+class CTransformersRunner:
+    def __init__(self, model_path, n_ctx):
+        from ctransformers import AutoModelForCausalLM
+        self.llm = AutoModelForCausalLM.from_pretrained(
+            model_path, model_type="llama", gpu_layers=0, context_length=n_ctx
+        )
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text)
+
+    def reset(self):
+        self.llm.reset()
+
+    def eval(self, tokens):
+        self.llm.eval(tokens)
+
+    def greedy(self):
+        return self.llm.sample(top_k=1, temperature=0.0)
+
+    def is_eos(self, token):
+        return self.llm.is_eos_token(token)
+
+    def detokenize(self, tokens):
+        return self.llm.detokenize(tokens)
+
+RUNNERS = {"llama_cpp": LlamaCppRunner, "ctransformers": CTransformersRunner}
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far, or None if the platform can't tell."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except ImportError:
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes on Linux
+
+def quantization(model_path):
+    match = re.search(r"\.((?:I?Q\d\w*)|F16|F32|BF16)\.gguf$", os.path.basename(model_path), re.IGNORECASE)
+    return match.group(1).upper() if match else "unknown"
+
+def run_one(backend, model_path, n_ctx, max_new_tokens):
+    """Loads one model with one backend and runs the prompt suite; returns the measurements."""
+    started_at = time.perf_counter()
+    runner = RUNNERS[backend](model_path, n_ctx)
+    load_s = time.perf_counter() - started_at
+    # Warm-up pass kept out of the prompt timings: with mmap the weights are only paged in by the
+    # first forward pass, which would otherwise land in the first prompt's prefill
+    started_at = time.perf_counter()
+    runner.eval(runner.tokenize(f"[SYSTEM]: {SYSTEM_PROMPT}\n[USER]: {PROMPTS[0]}\n[ASSISTANT]:"))
+    warmup_s = time.perf_counter() - started_at
+    prompts = []
+    for prompt in PROMPTS:
+        tokens = runner.tokenize(f"[SYSTEM]: {SYSTEM_PROMPT}\n[USER]: {prompt}\n[ASSISTANT]:")
+        runner.reset()
+        started_at = time.perf_counter()
+        runner.eval(tokens)
+        prefill_s = time.perf_counter() - started_at
+
+        generated = []
+        text = ""
+        decode_s = 0.0
+        while len(generated) < max_new_tokens:
+            started_at = time.perf_counter()
+            token = runner.greedy()
+            decode_s += time.perf_counter() - started_at
+            if runner.is_eos(token):
+                break
+            generated.append(token)
+            # Untimed: detokenize only the new token and look for a stop string at the end of the text
+            piece = runner.detokenize([token])
+            text += piece
+            if any(stop in text[-(len(stop) + len(piece)):] for stop in STOP):
+                break
+            started_at = time.perf_counter()
+            runner.eval([token])
+            decode_s += time.perf_counter() - started_at
+        prompts.append({
+            "prompt": prompt,
+            "prompt_tokens": len(tokens),
+            "prefill_tokens_per_second": round(len(tokens) / prefill_s, 2) if prefill_s > 0 else None,
+            "output_tokens": len(generated),
+            "output_chars": len(text),
+            "decode_tokens_per_second": round(len(generated) / decode_s, 2) if decode_s > 0 else None,
+        })
+    prompt_tokens = sum(p["prompt_tokens"] for p in prompts)
+    output_tokens = sum(p["output_tokens"] for p in prompts)
+    prefill_s = sum(p["prompt_tokens"] / p["prefill_tokens_per_second"] for p in prompts if p["prefill_tokens_per_second"])
+    decode_s = sum(p["output_tokens"] / p["decode_tokens_per_second"] for p in prompts if p["decode_tokens_per_second"])
+    return {
+        "backend": backend,
+        "model": os.path.basename(model_path),
+        "quantization": quantization(model_path),
+        "file_bytes": os.path.getsize(model_path),
+        "load_s": round(load_s, 3),
+        "warmup_s": round(warmup_s, 3),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "prefill_tokens_per_second": round(prompt_tokens / prefill_s, 2) if prefill_s > 0 else None,
+        "decode_tokens_per_second": round(output_tokens / decode_s, 2) if decode_s > 0 else None,
+        "output_tokens": output_tokens,
+        "prompts": prompts,
+    }
+
+def available_backends():
+    backends = []
+    for backend in BACKENDS:
+        try:
+            __import__(backend)
+            backends.append(backend)
+        except ImportError:
+            print(f"Skipping {backend}: not installed")
+    return backends
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare backends and GGUF quantizations on CPU.")
+    parser.add_argument("models", nargs="*", help="GGUF files (default: every *.gguf in --models-dir)")
+    parser.add_argument("--models-dir", default=".")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS)
+    parser.add_argument("--n-ctx", type=int, default=2048)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--output", help="write every measurement as JSON to this file")
+    parser.add_argument("--run", nargs=2, metavar=("BACKEND", "MODEL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # Child process: one backend, one model, results as JSON on the last stdout line
+        print(json.dumps(run_one(args.run[0], args.run[1], args.n_ctx, args.max_new_tokens)))
+        return
+
+    models = args.models or sorted(glob.glob(os.path.join(args.models_dir, "*.gguf")))
+    if not models:
+        sys.exit("No GGUF models found")
+    results = []
+    for backend in args.backends or available_backends():
+        for model in models:
+            print(f"Running {backend} on {os.path.basename(model)}...")
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run", backend, model,
+                 "--n-ctx", str(args.n_ctx), "--max-new-tokens", str(args.max_new_tokens)],
+                capture_output=True, text=True,
+            )
+            if child.returncode != 0:
+                error = child.stderr.strip().splitlines()[-1:] or ["unknown error"]
+                print(f"  failed: {error[0]}")
+                results.append({"backend": backend, "model": os.path.basename(model), "error": error[0]})
+                continue
+            results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    print(f"\n{'backend':<15}{'quant':<10}{'load s':>8}{'peak MB':>10}{'prefill t/s':>13}{'decode t/s':>12}{'out tok':>9}")
+    for r in results:
+        if "error" in r:
+            print(f"{r['backend']:<15}{quantization(r['model']):<10}  failed: {r['error']}")
+            continue
+        peak = f"{r['peak_rss_bytes'] / 2**20:.0f}" if r["peak_rss_bytes"] else "?"
+        print(f"{r['backend']:<15}{r['quantization']:<10}{r['load_s']:>8.2f}{peak:>10}"
+              f"{r['prefill_tokens_per_second'] or 0:>13.1f}{r['decode_tokens_per_second'] or 0:>12.1f}{r['output_tokens']:>9}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
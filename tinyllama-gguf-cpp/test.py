@@ -1,32 +1,42 @@
 from llama_cpp import Llama
+from autotune import load_tuning
+
+MODEL_PATH = "./tinyllama-1.1b-chat-v1.0.Q2_K.gguf"
+
+# Define custom system instructions
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant. Answer questions concisely and professionally. "
+    "Provide responses short and simple. Avoid technical jargon and complex sentences."
+)
+
+GENERATION_PARAMS = dict(
+    max_tokens=256,
+    temperature=0.7,
+    top_p=0.9,
+    top_k=50,
+    repeat_penalty=1.1,
+    stop=["[USER]:", "\n[ASSISTANT]:"]
+)
+
+def load_model(model_path=MODEL_PATH, **params):
+    """Loads the GGUF with the settings autotune.py saved for it (params override them)."""
+    return Llama(model_path=model_path, use_mmap=True, verbose=False, **{**load_tuning(model_path), **params})
+
+def generate(llm, user_input, system_prompt=SYSTEM_PROMPT, **overrides):
+    """Runs one completion and returns the llama_cpp response dict."""
+    # Combine system instructions with user input
+    prompt = f"[SYSTEM]: {system_prompt}\n[USER]: {user_input}\n[ASSISTANT]:"
+    return llm(prompt, **{**GENERATION_PARAMS, **overrides})
 
 def main():
     # Initialize the Llama model
-    model_path = "./tinyllama-1.1b-chat-v1.0.Q2_K.gguf"
-    llm = Llama(model_path=model_path, use_mmap=True, verbose=False)
-
-    # Define custom system instructions
-    system_prompt = (
-        "You are a helpful AI assistant. Answer questions concisely and professionally. "
-        "Provide responses short and simple. Avoid technical jargon and complex sentences."
-    )
-    
+    llm = load_model()
+
     # User input
     user_input = "Who is Elon Musk?"
-    
-    # Combine system instructions with user input
-    prompt = f"[SYSTEM]: {system_prompt}\n[USER]: {user_input}\n[ASSISTANT]:"
 
     # Generate response
-    response = llm(
-        prompt,
-        max_tokens=256,
-        temperature=0.7,
-        top_p=0.9,
-        top_k=50,
-        repeat_penalty=1.1,
-        stop=["[USER]:", "\n[ASSISTANT]:"]
-    )
+    response = generate(llm, user_input)
 
     # Extract and print the text from the response
     text = response["choices"][0]["text"]